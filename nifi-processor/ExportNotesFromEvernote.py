@@ -13,30 +13,367 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from evernote.edam.notestore.ttypes import NoteFilter, NotesMetadataResultSpec
+from evernote.edam.notestore.ttypes import NoteFilter, NotesMetadataResultSpec, SyncChunkFilter
 from nifiapi.properties import PropertyDescriptor
 from nifiapi.properties import StandardValidators
 from nifiapi.properties import ExpressionLanguageScope
 from nifiapi.flowfiletransform import FlowFileTransform, FlowFileTransformResult
 
 from evernote.api.client import EvernoteClient
+from evernote.edam.error.ttypes import EDAMErrorCode, EDAMNotFoundException, EDAMSystemException
+from evernote.edam.type.ttypes import Note, NoteSortOrder
 import evernote.edam.userstore.constants as UserStoreConstants
 
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from xml.sax.saxutils import escape, quoteattr
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+import base64
+import glob
+import gzip
+import io
+import json
 import os
 import re
-
-
+import sqlite3
+import threading
+import time
+
+import zstandard
+
+
+CHECKPOINT_FILE_NAME = ".evernote-export-checkpoint.json"
+CONTENT_HASH_INDEX_FILE_NAME = ".evernote-export-content-hashes.db"
+COMPRESSION_EXTENSIONS = {'None': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def open_enex_output(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, "wt", encoding="utf-8")
+    if compression == 'zstd':
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, "wb")), encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+
+def open_enex_buffer(buffer, compression):
+    # Returns the compressing stream the enex text is written through into the buffer, or None when it is not compressed.
+    # Neither stream closes the buffer when it is closed
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=buffer, mode="wb")
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().stream_writer(buffer, closefd=False)
+    return None
+
+
+class CountingFile:
+    # Counts the characters written through it to know the uncompressed size of an enex document
+
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+
+    def write(self, text):
+        self.count += len(text)
+        self.file.write(text)
+
+
+# The enex document is written straight to the output in a single pass instead of building an element tree and
+# pretty printing it, which needs several copies of the note content in memory.
+def write_enex_header(file, export_date):
+    file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    file.write(f'<en-export export-date={quoteattr(export_date)} application="Evernote" version="10.44.8">\n')
+
+
+def write_enex_footer(file):
+    file.write('</en-export>\n')
+
+
+def write_enex_cdata(file, text):
+    # ']]>' cannot appear inside a CDATA section so it is split over two sections
+    file.write('<![CDATA[')
+    file.write(text.replace(']]>', ']]]]><![CDATA[>'))
+    file.write(']]>')
+
+
+def write_enex_resource(file, mime, file_name, data):
+    file.write('    <resource>\n')
+    file.write('      <data encoding="base64">\n')
+    # Encode the data a slice at a time so a large attachment is never held base64 encoded in memory in full
+    for offset in range(0, len(data), 57 * 1024):
+        file.write(base64.encodebytes(data[offset:offset + 57 * 1024]).decode('ascii'))
+    file.write('      </data>\n')
+    file.write(f'      <mime>{escape(mime)}</mime>\n')
+    if file_name is not None:
+        file.write(f'      <resource-attributes>\n        <file-name>{escape(file_name)}</file-name>\n      </resource-attributes>\n')
+    file.write('    </resource>\n')
+
+
+def write_enex_note(file, title, created, updated, tags, content, resources=None, export_file_name=None):
+    file.write('  <note>\n')
+    file.write(f'    <title>{escape(title)}</title>\n')
+    if export_file_name is not None:
+        # Notes that share an enex document carry the name of the file they would have been exported to on their own
+        file.write(f'    <export-file-name>{escape(export_file_name)}</export-file-name>\n')
+    file.write(f'    <created>{created}</created>\n')
+    file.write(f'    <updated>{updated}</updated>\n')
+    file.write(f'    <tags>{escape(tags)}</tags>\n')
+    file.write('    <content>')
+    if content is not None:
+        write_enex_cdata(file, content)
+    file.write('</content>\n')
+    for mime, file_name, data in resources or []:
+        write_enex_resource(file, mime, file_name, data)
+    file.write('  </note>\n')
+
+
+class ExportCheckpoint:
+    # Durable record of the export progress kept in a local json file. It holds the window for the next run, the last
+    # synced update sequence number, the notes that failed to export and, while a run is in progress, how far the run got
+    # in every notebook.
+
+    def __init__(self, path, save_run_progress=True):
+        self.path = path
+        # When the exported notes are only handed over at the end of the run, the progress within the run must not be
+        # persisted before that or an interrupted run would lose the notes it had not handed over yet
+        self.save_run_progress = save_run_progress
+        self.state = {"export_from_timestamp": None, "sync_usn": 0, "failed_note_guids": [], "run": None}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                self.state.update(json.load(file))
+
+    def save(self):
+        # Write a temporary file and swap it in so a crash in the middle of a save never leaves a corrupt checkpoint
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(self.state, file)
+        os.replace(temp_path, self.path)
+
+    def begin_run(self, started_timestamp, export_from_timestamp):
+        # A run left behind by a crash or a stop is resumed instead of starting over
+        if self.state["run"] is None:
+            self.state["run"] = {"started": started_timestamp, "export_from_timestamp": export_from_timestamp,
+                                 "started_sync_usn": self.state["sync_usn"], "completed_notebooks": [], "notebook_progress": {}}
+            self.save()
+        return self.state["run"]
+
+    def is_notebook_completed(self, notebook_guid):
+        return notebook_guid in self.state["run"]["completed_notebooks"]
+
+    def notebook_progress(self, notebook_guid):
+        # The updated time (in ms) of the last note of the notebook that was handled in this run, along with the guids of
+        # the handled notes updated in that same millisecond
+        return self.state["run"]["notebook_progress"].get(notebook_guid, {"updated": 0, "guids": []})
+
+    def save_progress(self):
+        if self.save_run_progress:
+            self.save()
+
+    def record_notebook_progress(self, notebook_guid, last_note_updated, last_note_guids):
+        self.state["run"]["notebook_progress"][notebook_guid] = {"updated": last_note_updated, "guids": sorted(last_note_guids)}
+        self.save_progress()
+
+    def complete_notebook(self, notebook_guid):
+        self.state["run"]["completed_notebooks"].append(notebook_guid)
+        self.state["run"]["notebook_progress"].pop(notebook_guid, None)
+        self.save_progress()
+
+    def record_sync_usn(self, sync_usn):
+        self.state["sync_usn"] = sync_usn
+        self.save_progress()
+
+    def failed_note_guids(self):
+        # Notes that could not be exported are kept until an export of them succeeds, even past the end of the run, as the
+        # window of the next run no longer holds them
+        return list(self.state["failed_note_guids"])
+
+    def record_failed_note(self, note_guid):
+        if note_guid not in self.state["failed_note_guids"]:
+            self.state["failed_note_guids"].append(note_guid)
+            self.save_progress()
+
+    def clear_failed_note(self, note_guid):
+        if note_guid in self.state["failed_note_guids"]:
+            self.state["failed_note_guids"].remove(note_guid)
+            self.save_progress()
+
+    def complete_run(self):
+        # The next run picks up every note changed since this run started
+        self.state["export_from_timestamp"] = self.state["run"]["started"]
+        self.state["run"] = None
+        self.save()
+
+
+class EnexBatchWriter:
+    # Packs the exported notes into multi-note enex files of up to a number of notes and/or uncompressed megabytes.
+    # A file is written under a hidden name and only gets its final name once it is complete, so a ListFile never
+    # picks up a file that is still being written.
+
+    def __init__(self, output_directory, file_prefix, max_notes, max_bytes, compression, on_file_completed):
+        self.output_directory = output_directory
+        self.file_prefix = file_prefix
+        self.max_notes = max_notes
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.on_file_completed = on_file_completed
+        self.batch_number = 0
+        self.file = None
+
+    def open_next_file(self):
+        # A run resumed within the same second as the failed one has the same file prefix, so its completed batch files are skipped
+        self.path = None
+        while self.path is None or os.path.exists(self.path):
+            self.batch_number += 1
+            self.path = os.path.join(self.output_directory, f"{self.file_prefix}__Batch__{self.batch_number:05d}.enex{COMPRESSION_EXTENSIONS[self.compression]}")
+        self.temp_path = os.path.join(self.output_directory, "." + os.path.basename(self.path) + ".part")
+        self.file = CountingFile(open_enex_output(self.temp_path, self.compression))
+        self.note_count = 0
+        write_enex_header(self.file, datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ"))
+
+    def write_note(self, *note_fields):
+        if self.file is None:
+            self.open_next_file()
+        path = self.path
+        write_enex_note(self.file, *note_fields)
+        self.note_count += 1
+
+        if (self.max_notes > 0 and self.note_count >= self.max_notes) or (self.max_bytes > 0 and self.file.count >= self.max_bytes):
+            self.close()
+        return path
+
+    def close(self):
+        if self.file is None:
+            return
+        write_enex_footer(self.file)
+        self.file.file.close()
+        self.file = None
+        os.replace(self.temp_path, self.path)
+        self.on_file_completed()
+
+    def abandon(self):
+        # The notes of a batch file that is not complete are exported again by the run that resumes
+        if self.file is None:
+            return
+        self.file.file.close()
+        self.file = None
+        os.remove(self.temp_path)
+
+
+class EnexFlowFileWriter:
+    # Writes the exported notes into the enex document that becomes the content of the outgoing FlowFile. The document is
+    # compressed as it is written, so only the compressed content is held in memory. Like a batch file it is full once it
+    # holds a number of notes and/or uncompressed megabytes, and the rest of the run goes into the next FlowFile.
+
+    def __init__(self, max_notes, max_bytes, compression):
+        self.max_notes = max_notes
+        self.max_bytes = max_bytes
+        self.buffer = io.BytesIO()
+        self.stream = open_enex_buffer(self.buffer, compression)
+        self.text_file = io.TextIOWrapper(self.stream or self.buffer, encoding="utf-8")
+        self.file = CountingFile(self.text_file)
+        self.note_count = 0
+        write_enex_header(self.file, datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ"))
+
+    def write_note(self, *note_fields):
+        write_enex_note(self.file, *note_fields)
+        self.note_count += 1
+
+    @property
+    def remaining_notes(self):
+        # None when the number of notes is not limited
+        return self.max_notes - self.note_count if self.max_notes > 0 else None
+
+    @property
+    def is_full(self):
+        return (self.max_notes > 0 and self.note_count >= self.max_notes) or (self.max_bytes > 0 and self.file.count >= self.max_bytes)
+
+    def close(self):
+        # Returns the FlowFile content. The text wrapper is detached so it does not close the buffer along with it
+        write_enex_footer(self.file)
+        self.text_file.flush()
+        self.text_file.detach()
+        if self.stream is not None:
+            self.stream.close()
+        return self.buffer.getvalue()
+
+
+class ContentHashIndex:
+    # Local sqlite index of the content hash of every exported note, keyed by note guid. Used to skip notes whose
+    # content did not change, e.g. when a note was only moved or re-tagged, so they are not split and embedded again.
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS note_content_hash (guid TEXT PRIMARY KEY, content_hash TEXT NOT NULL)")
+        self.connection.commit()
+
+    def is_unchanged(self, note):
+        if note.contentHash is None:
+            return False
+        row = self.connection.execute("SELECT content_hash FROM note_content_hash WHERE guid = ?", (note.guid,)).fetchone()
+        return row is not None and row[0] == note.contentHash.hex()
+
+    def record(self, note):
+        if note.contentHash is not None:
+            self.connection.execute("INSERT OR REPLACE INTO note_content_hash (guid, content_hash) VALUES (?, ?)", (note.guid, note.contentHash.hex()))
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+
+class RateLimitScheduler:
+    # Runs the Evernote API calls of an export run. When Evernote reports that the rate limit was reached, every caller
+    # is paused for the rateLimitDuration it returned and the call is retried, so the run continues where it was.
+
+    def __init__(self, logger, max_wait_seconds, max_retries=5):
+        self.logger = logger
+        self.max_wait_seconds = max_wait_seconds
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.resume_at = 0
+        self.throttled_seconds = 0
+
+    def call(self, method, *args):
+        retries = 0
+        while True:
+            with self.lock:
+                pause = self.resume_at - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+
+            try:
+                return method(*args)
+            except EDAMSystemException as e:
+                if e.errorCode != EDAMErrorCode.RATE_LIMIT_REACHED or retries >= self.max_retries:
+                    raise
+                # A pause longer than we are willing to block the processor for fails the run. The checkpoint lets
+                # the next run resume from here
+                rate_limit_duration = e.rateLimitDuration if e.rateLimitDuration is not None else 60
+                if rate_limit_duration > self.max_wait_seconds:
+                    raise
+                retries += 1
+                self.pause(rate_limit_duration)
+
+    def pause(self, rate_limit_duration):
+        with self.lock:
+            now = time.monotonic()
+            resume_at = now + rate_limit_duration
+            if resume_at > self.resume_at:
+                # Only count the part of the pause that is not already covered by the pause of another caller
+                self.throttled_seconds += resume_at - max(self.resume_at, now)
+                self.resume_at = resume_at
+                self.logger.info("Evernote rate limit reached. Pausing the export for " + str(rate_limit_duration) + " seconds")
 
 
 class ExportNotesFromEvernote(FlowFileTransform):
     class Java:
         implements = ['org.apache.nifi.python.processor.FlowFileTransform']
     class ProcessorDetails:
-        dependencies = ['evernote3', 'oauth2' ]
+        dependencies = ['evernote3', 'oauth2', 'zstandard' ]
         version = '0.0.1-SNAPSHOT'
         description = 'Perform a full export of Notes from your Evernote or incrementally exports based on from export date/time. The exported notes are written to a configured location as an enex format. '
         tags = ['Evernote']
@@ -53,7 +390,7 @@ class ExportNotesFromEvernote(FlowFileTransform):
 
         self.export_directory= PropertyDescriptor(
             name="Export Directory",
-            description="The full path to a directory where the Notes will be exported to",
+            description="The full path to a directory where the Notes will be exported to. When the Output Destination is 'FlowFile Content' it only holds the default checkpoint file",
             required=True,
         )
 
@@ -71,7 +408,107 @@ class ExportNotesFromEvernote(FlowFileTransform):
 
 
 
-        self.descriptors = [self.evernote_auth_token, self.export_directory, self.stack_filter, self.export_from_dtm]
+        self.note_fetch_parallelism = PropertyDescriptor(
+            name="Note Fetch Parallelism",
+            description="The maximum number of notes whose content is retrieved from Evernote at the same time. Notes are still written out in the order Evernote returns them.",
+            default_value="4",
+            required=True,
+            validators=[StandardValidators.POSITIVE_INTEGER_VALIDATOR]
+        )
+
+        self.export_mode = PropertyDescriptor(
+            name="Export Mode",
+            description="How notes to export are found. 'Notebook Scan' pages through the note metadata of every notebook on each run. 'Incremental Sync (USN)' uses the Evernote update sequence numbers to only retrieve the notes that changed since the last run, so a run with no changes costs a single call.",
+            default_value="Notebook Scan",
+            required=True,
+            allowable_values=['Notebook Scan', 'Incremental Sync (USN)']
+        )
+
+        self.checkpoint_file = PropertyDescriptor(
+            name="Checkpoint File",
+            description="The full path of the file where the export progress is recorded, so an export resumes where it left off after a restart or a stop/start of the processor. Defaults to the hidden file " + CHECKPOINT_FILE_NAME + " in the Export Directory. Once a checkpoint exists it takes precedence over the Export from Date/Time. Delete the file to start over.",
+            required=False,
+        )
+
+        self.resource_export = PropertyDescriptor(
+            name="Resource Export",
+            description="Which note resources (images, PDFs, audio etc.) are exported. 'None' only retrieves the note content without downloading any resource data. 'Indexed MIME Types' downloads the data of the resources whose MIME type is listed in Indexed Resource MIME Types, one resource at a time, and writes them into the enex file.",
+            default_value="None",
+            required=True,
+            allowable_values=['None', 'Indexed MIME Types']
+        )
+
+        self.indexed_resource_mime_types = PropertyDescriptor(
+            name="Indexed Resource MIME Types",
+            description="A comma separated list of the MIME types of the resources to export when Resource Export is 'Indexed MIME Types'. A trailing * matches any subtype (e.g: image/*).",
+            default_value="application/pdf,text/plain",
+            required=False,
+        )
+
+        self.max_rate_limit_wait = PropertyDescriptor(
+            name="Max Rate Limit Wait",
+            description="The longest time in seconds the export pauses for when Evernote reports that the API rate limit was reached. If Evernote asks for a longer pause, or still reports the rate limit after 5 pauses for the same call, the run fails and the next run resumes from the checkpoint.",
+            default_value="3600",
+            required=True,
+            validators=[StandardValidators.POSITIVE_INTEGER_VALIDATOR]
+        )
+
+        self.output_destination = PropertyDescriptor(
+            name="Output Destination",
+            description="Where the exported notes are written to. 'Export Directory' writes every note to its own enex file in the Export Directory. 'FlowFile Content' writes the exported notes into a single enex document that becomes the content of the outgoing FlowFile, so no files have to be listed and read back from disk. A FlowFile holds up to Notes per FlowFile notes and Max Megabytes per Export File, the rest of the run is exported by the next triggers of the processor. When there is nothing to export no FlowFile is sent to success.",
+            default_value="Export Directory",
+            required=True,
+            allowable_values=['Export Directory', 'FlowFile Content']
+        )
+
+        self.unchanged_content_strategy = PropertyDescriptor(
+            name="Unchanged Content Strategy",
+            description="What to do with an updated note whose content hash is the same as when it was last exported, e.g. because it was only moved or re-tagged. 'Export' exports it again. 'Skip' does not export it so it is not split and embedded again. In the Incremental Sync (USN) mode a skipped note is not even retrieved from Evernote.",
+            default_value="Export",
+            required=True,
+            allowable_values=['Export', 'Skip']
+        )
+
+        self.content_hash_index_file = PropertyDescriptor(
+            name="Content Hash Index File",
+            description="The full path of the sqlite file that holds the content hash of every exported note when the Unchanged Content Strategy is 'Skip'. Defaults to the hidden file " + CONTENT_HASH_INDEX_FILE_NAME + " in the Export Directory.",
+            required=False,
+        )
+
+        self.notes_per_export_file = PropertyDescriptor(
+            name="Notes per Export File",
+            description="The number of notes packed into a single enex file in the Export Directory. 1 writes every note to its own file. With any other value the notes are written to batch files named Evernote_Export__<run time>__Batch__<number>.enex, where 0 puts no limit on the number of notes in a file.",
+            default_value="1",
+            required=True,
+            validators=[StandardValidators.NON_NEGATIVE_INTEGER_VALIDATOR]
+        )
+
+        self.notes_per_flowfile = PropertyDescriptor(
+            name="Notes per FlowFile",
+            description="The most notes written to the content of a FlowFile when the Output Destination is 'FlowFile Content'. 0 puts no limit on the number of notes in a FlowFile.",
+            default_value="1000",
+            required=True,
+            validators=[StandardValidators.NON_NEGATIVE_INTEGER_VALIDATOR]
+        )
+
+        self.max_megabytes_per_export_file = PropertyDescriptor(
+            name="Max Megabytes per Export File",
+            description="When notes are batched, a new batch file is started once the uncompressed size of the current one reaches this many megabytes. When the Output Destination is 'FlowFile Content' no more notes are written to a FlowFile once its content reaches this size. 0 puts no limit on the size.",
+            default_value="0",
+            required=True,
+            validators=[StandardValidators.NON_NEGATIVE_INTEGER_VALIDATOR]
+        )
+
+        self.export_compression = PropertyDescriptor(
+            name="Export Compression",
+            description="The compression applied to the exported enex files or FlowFile content. The file extension .gz or .zst is appended to the file names.",
+            default_value="None",
+            required=True,
+            allowable_values=['None', 'gzip', 'zstd']
+        )
+
+        self.descriptors = [self.evernote_auth_token, self.export_directory, self.stack_filter, self.export_from_dtm, self.note_fetch_parallelism, self.export_mode, self.checkpoint_file, self.resource_export, self.indexed_resource_mime_types, self.max_rate_limit_wait, self.output_destination, self.unchanged_content_strategy, self.content_hash_index_file, self.notes_per_export_file, self.notes_per_flowfile, self.max_megabytes_per_export_file, self.export_compression]
+        self.content_hash_index = None
 
     def onScheduled(self, context):
         self.logger.info("Initializing Evernote Store")
@@ -79,16 +516,18 @@ class ExportNotesFromEvernote(FlowFileTransform):
         # Get the properties from the processor needed to configure the OpenAI Embedding Service
         evernote_auth_token = context.getProperty(self.evernote_auth_token.name).getValue()
 
-        client = EvernoteClient(token=evernote_auth_token, sandbox=False, china=False)
-        user_store = client.get_user_store()
-        version_ok = user_store.checkVersion(
-            "Evernote EDAMTest (Python)",
-            UserStoreConstants.EDAM_VERSION_MAJOR,
-            UserStoreConstants.EDAM_VERSION_MINOR
-        )
-        self.logger.info("Is my Evernote API version up to date: " +  str(version_ok))
-
+        client = self.create_evernote_client(evernote_auth_token)
+        self.evernote_client = client
         self.note_store = client.get_note_store()
+        self.thread_local = threading.local()
+        self.note_fetch_parallelism_value = context.getProperty(self.note_fetch_parallelism.name).asInteger()
+        self.max_rate_limit_wait_value = context.getProperty(self.max_rate_limit_wait.name).asInteger()
+
+        # The MIME types of the resources whose data is downloaded. Empty when no resources are exported
+        self.indexed_resource_mime_types_value = []
+        if context.getProperty(self.resource_export.name).getValue() == 'Indexed MIME Types':
+            mime_types = context.getProperty(self.indexed_resource_mime_types.name).getValue() or ''
+            self.indexed_resource_mime_types_value = [mime_type.strip() for mime_type in mime_types.split(',') if mime_type.strip() != '']
 
         export_from_dtm_string = context.getProperty(self.export_from_dtm.name).getValue()
         if export_from_dtm_string is None or export_from_dtm_string == '':
@@ -100,7 +539,51 @@ class ExportNotesFromEvernote(FlowFileTransform):
         dt_object = datetime.strptime(export_from_dtm_string, "%Y-%m-%d %H:%M:%S")
         self.export_from_dtm_timestamp_window = int(dt_object.timestamp())
 
-        self.logger.info(f" The export from dtm that is initally set is timestamp[ {self.export_from_dtm_timestamp_window}] with string format[{export_from_dtm_string}]")
+        # Load the checkpoint left behind by earlier runs. It wins over the configured export from date/time
+        checkpoint_file = context.getProperty(self.checkpoint_file.name).getValue()
+        if checkpoint_file is None or checkpoint_file == '':
+            checkpoint_file = os.path.join(context.getProperty(self.export_directory.name).getValue(), CHECKPOINT_FILE_NAME)
+        self.output_destination_value = context.getProperty(self.output_destination.name).getValue()
+        self.notes_per_export_file_value = context.getProperty(self.notes_per_export_file.name).asInteger()
+        self.notes_per_flowfile_value = context.getProperty(self.notes_per_flowfile.name).asInteger()
+        self.max_bytes_per_export_file = context.getProperty(self.max_megabytes_per_export_file.name).asInteger() * 1024 * 1024
+        self.export_compression_value = context.getProperty(self.export_compression.name).getValue()
+
+        # Batch files and the FlowFile content only hand over their notes once they are complete, so the progress is saved then
+        save_run_progress = self.output_destination_value == 'Export Directory' and self.notes_per_export_file_value == 1
+        self.checkpoint = ExportCheckpoint(checkpoint_file, save_run_progress=save_run_progress)
+        if self.checkpoint.state["export_from_timestamp"] is not None:
+            self.export_from_dtm_timestamp_window = self.checkpoint.state["export_from_timestamp"]
+            self.logger.info("Export from dtm restored from checkpoint file: " + checkpoint_file)
+
+        self.logger.info(f" The export from dtm that is initally set is timestamp[ {self.export_from_dtm_timestamp_window}] with string format[{datetime.fromtimestamp(self.export_from_dtm_timestamp_window).strftime('%Y-%m-%d %H:%M:%S')}]")
+
+        # The update sequence number the incremental sync has processed up to. 0 means a full sync
+        self.last_sync_usn = self.checkpoint.state["sync_usn"]
+
+        # The content hash index is only kept when notes with unchanged content are skipped
+        self.content_hash_index = None
+        if context.getProperty(self.unchanged_content_strategy.name).getValue() == 'Skip':
+            content_hash_index_file = context.getProperty(self.content_hash_index_file.name).getValue()
+            if content_hash_index_file is None or content_hash_index_file == '':
+                content_hash_index_file = os.path.join(context.getProperty(self.export_directory.name).getValue(), CONTENT_HASH_INDEX_FILE_NAME)
+            self.content_hash_index = ContentHashIndex(content_hash_index_file)
+
+    def onStopped(self, context):
+        if self.content_hash_index is not None:
+            self.content_hash_index.close()
+            self.content_hash_index = None
+
+    def create_evernote_client(self, evernote_auth_token):
+        client = EvernoteClient(token=evernote_auth_token, sandbox=False, china=False)
+        user_store = client.get_user_store()
+        version_ok = user_store.checkVersion(
+            "Evernote EDAMTest (Python)",
+            UserStoreConstants.EDAM_VERSION_MAJOR,
+            UserStoreConstants.EDAM_VERSION_MINOR
+        )
+        self.logger.info("Is my Evernote API version up to date: " +  str(version_ok))
+        return client
 
     def escape_filename(self, filename):
         # Replace any characters that are not allowed in filenames with an underscore (_)
@@ -109,7 +592,7 @@ class ExportNotesFromEvernote(FlowFileTransform):
 
     def retrieve_all_notebooks(self, stack_filter=None):
         # Retrieve all notebooks
-        notebooks = self.note_store.listNotebooks()
+        notebooks = self.scheduler.call(self.note_store.listNotebooks)
         if (stack_filter is None):
             return notebooks
         else:
@@ -118,144 +601,458 @@ class ExportNotesFromEvernote(FlowFileTransform):
 
 
 
+    def get_note_store(self):
+        # The Thrift client behind a note store is not thread safe, so every fetch thread gets its own note store
+        note_store = getattr(self.thread_local, "note_store", None)
+        if note_store is None:
+            note_store = self.evernote_client.get_note_store()
+            self.thread_local.note_store = note_store
+        return note_store
+
+    def is_indexed_resource(self, resource):
+        for mime_type in self.indexed_resource_mime_types_value:
+            if resource.mime == mime_type or (mime_type.endswith('*') and resource.mime is not None and resource.mime.startswith(mime_type[:-1])):
+                return True
+        return False
+
+    def fetch_note(self, note_guid):
+        # Retrieve the note content without the resource data. This runs on one of the fetch threads
+        note_store = self.get_note_store()
+        note = self.scheduler.call(note_store.getNote, note_guid, True, False, False, False)
+
+        # Only the data of the resources we index is downloaded, one resource at a time
+        resources = []
+        for resource in note.resources or []:
+            if self.is_indexed_resource(resource):
+                file_name = resource.attributes.fileName if resource.attributes is not None else None
+                resources.append((resource.mime, file_name, self.scheduler.call(note_store.getResourceData, resource.guid)))
+        return note, resources
+
+    def load_tag_names(self):
+        # A single listTags call gives the names of all the tags in the account
+        self.tag_names_by_guid = {tag.guid: tag.name for tag in self.scheduler.call(self.note_store.listTags)}
+
+    def resolve_tag_names(self, tag_guids):
+        # Tag names are looked up in the tag map loaded once per run instead of calling getNoteTagNames for each note
+        if tag_guids is None:
+            return []
+        if self.tag_names_by_guid is None:
+            self.load_tag_names()
+
+        unknown_tag_guids = [tag_guid for tag_guid in tag_guids
+                             if tag_guid not in self.tag_names_by_guid and tag_guid not in self.unresolved_tag_guids]
+        if len(unknown_tag_guids) > 0:
+            # A tag was created since the tags were loaded so refresh them. An unknown guid only triggers one refresh per run
+            self.load_tag_names()
+            self.unresolved_tag_guids.update(tag_guid for tag_guid in unknown_tag_guids if tag_guid not in self.tag_names_by_guid)
+
+        return [self.tag_names_by_guid[tag_guid] for tag_guid in tag_guids if tag_guid in self.tag_names_by_guid]
+
+    def write_note(self, notebook, note, tag_names, resources, output_directory):
+        # Access note metadata
+        note_guid = note.guid
+        note_title = note.title
+        # The enex dates are UTC, which is what the trailing Z stands for
+        note_created = datetime.fromtimestamp(note.created / 1000, timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        note_updated = datetime.fromtimestamp(note.updated / 1000, timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+        self.logger.info("Exporting note with title: "+ note_title)
+
+        # Access the Content
+        note_content = note.content
+
+        # Specify the output file path
+        file_name = f"Notebook__{notebook.name}__Note__{note_title}__Id__{note_guid[-4:]}.enex"
+
+        escaped_file_named= self.escape_filename(file_name)
+        output_path = os.path.join(output_directory, escaped_file_named)
+
+        # The tags element is always written. If there are no tags it just has an empty value
+        if len(tag_names) == 0:
+            tag_names = [' ']
+
+        if self.flowfile_enex is not None:
+            # Append the note to the enex document that becomes the content of the outgoing FlowFile
+            self.flowfile_enex.write_note(f"{notebook.name} - {note_title}", note_created, note_updated, ','.join(tag_names), note_content, resources, escaped_file_named)
+            return "FlowFile content as " + escaped_file_named
+
+        if self.enex_batch_writer is not None:
+            batch_path = self.enex_batch_writer.write_note(f"{notebook.name} - {note_title}", note_created, note_updated, ','.join(tag_names), note_content, resources, escaped_file_named)
+            return batch_path + " as " + escaped_file_named
+
+        # Stream the note straight into the enex file
+        output_path += COMPRESSION_EXTENSIONS[self.export_compression_value]
+        with open_enex_output(output_path, self.export_compression_value) as file:
+            write_enex_header(file, datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ"))
+            write_enex_note(file, f"{notebook.name} - {note_title}", note_created, note_updated, ','.join(tag_names), note_content, resources)
+            write_enex_footer(file)
+
+        return output_path
+
+    def discard_run_progress(self):
+        # The progress made since the checkpoint was last saved belongs to notes that were never handed over, e.g. the
+        # notes of an unfinished batch file. It is dropped along with them by reloading the checkpoint, so the next
+        # run exports them again. The content hash index is rolled back to the same point
+        if self.enex_batch_writer is not None:
+            self.enex_batch_writer.abandon()
+        self.checkpoint = ExportCheckpoint(self.checkpoint.path, save_run_progress=self.checkpoint.save_run_progress)
+        self.last_sync_usn = self.checkpoint.state["sync_usn"]
+        if self.content_hash_index is not None:
+            self.content_hash_index.rollback()
+
+    def save_batch_progress(self):
+        # Every note the checkpoint and the content hash index know about is in a completed batch file at this point
+        self.checkpoint.save()
+        if self.content_hash_index is not None:
+            self.content_hash_index.commit()
+
+    def is_unchanged_note(self, note):
+        if self.content_hash_index is None or not self.content_hash_index.is_unchanged(note):
+            return False
+        self.logger.info("Skipping note with unchanged content: " + note.title)
+        self.run_unchanged_note_count += 1
+        return True
+
+    def export_note_batch(self, executor, notes_to_export, notebooks_by_guid, output_directory, failed_notes):
+        # Sync chunks already carry the content hash so unchanged notes are skipped before their content is retrieved
+        notes_to_export = [note_summary for note_summary in notes_to_export
+                           if getattr(note_summary, "contentHash", None) is None or not self.is_unchanged_note(note_summary)]
+
+        # Retrieve the content of the notes concurrently, a window of notes ahead of the one being written. When the
+        # FlowFile content can only take a few more notes no more are fetched than it can take, as the fetches beyond
+        # a full FlowFile are thrown away
+        fetches = {}
+        next_fetch_index = 0
+        exported_note_count = 0
+        for note_index, note_summary in enumerate(notes_to_export):
+            fetch_window = 2 * self.note_fetch_parallelism_value
+            if self.flowfile_enex is not None and self.flowfile_enex.remaining_notes is not None:
+                fetch_window = min(fetch_window, self.flowfile_enex.remaining_notes)
+            while next_fetch_index < len(notes_to_export) and next_fetch_index < note_index + max(fetch_window, 1):
+                fetches[next_fetch_index] = executor.submit(self.fetch_note, notes_to_export[next_fetch_index].guid)
+                next_fetch_index += 1
+            fetch = fetches.pop(note_index)
+
+            note_title = note_summary.title
+            try:
+                note, resources = fetch.result()
+            except EDAMSystemException as e:
+                if e.errorCode == EDAMErrorCode.RATE_LIMIT_REACHED:
+                    # The rate limit outlasted the Max Rate Limit Wait or the retries of the scheduler. Failing the run
+                    # leaves it open in the checkpoint so the next run resumes it instead of losing these notes
+                    for pending_fetch in fetches.values():
+                        pending_fetch.cancel()
+                    raise
+                self.record_failed_note(note_summary, failed_notes, e)
+                continue
+            except EDAMNotFoundException:
+                self.logger.info("Note[" + note_title + "] no longer exists in Evernote")
+                self.checkpoint.clear_failed_note(note_summary.guid)
+                continue
+            except Exception as e:
+                self.record_failed_note(note_summary, failed_notes, e)
+                continue
+
+            self.checkpoint.clear_failed_note(note.guid)
+            if getattr(note_summary, "contentHash", None) is None and self.is_unchanged_note(note):
+                continue
+
+            tag_names = self.resolve_tag_names(note.tagGuids)
+            notebook = notebooks_by_guid.get(note.notebookGuid)
+            if notebook is None:
+                # A note that failed in an earlier run may have been moved out of the exported notebooks since
+                self.logger.info("Note[" + note.title + "] is no longer in an exported notebook")
+                continue
+            output_path = self.write_note(notebook, note, tag_names, resources, output_directory)
+
+            if self.content_hash_index is not None:
+                self.content_hash_index.record(note)
+
+            exported_note_count += 1
+            self.run_exported_note_count += 1
+            self.logger.info("Note[" + note.title +"] in notebook["+notebook.name+"]  saved to: " + output_path)
+
+            if self.flowfile_enex is not None and self.flowfile_enex.is_full:
+                # The rest of the batch goes into the next FlowFile. The caller records the progress up to this note
+                self.flowfile_full_after = note_summary
+                for pending_fetch in fetches.values():
+                    pending_fetch.cancel()
+                break
+
+        # Like the checkpoint, the content hashes of notes only handed over at the end of the run are saved then
+        if self.content_hash_index is not None and self.checkpoint.save_run_progress:
+            self.content_hash_index.commit()
+
+        return exported_note_count
+
+    def record_failed_note(self, note_summary, failed_notes, error):
+        self.logger.info("Error occurred while retrieving note["+note_summary.title+"]: " + str(error))
+        failed_notes.append(note_summary)
+        self.checkpoint.record_failed_note(note_summary.guid)
+
+    def failed_notes_from_checkpoint(self):
+        # The notes that failed in earlier runs are retried along with the ones that fail in this run. Only their guid is
+        # known, which is all that is needed to retrieve them
+        return [Note(guid=note_guid, title=note_guid) for note_guid in self.checkpoint.failed_note_guids()]
+
+    def retry_failed_notes(self, executor, failed_notes, notebooks_by_guid, output_directory):
+        # Notes that failed during the run get one more try at the end of it. Returns the notes that failed again. A note
+        # exported since it failed, e.g. because it was updated again, is not retried
+        failed_note_guids = self.checkpoint.failed_note_guids()
+        failed_notes = [note for note in {note.guid: note for note in failed_notes}.values() if note.guid in failed_note_guids]
+        if len(failed_notes) == 0:
+            return 0, failed_notes
+
+        self.logger.info("Retrying " + str(len(failed_notes)) + " notes that failed to export")
+        still_failed_notes = []
+        exported_note_count = self.export_note_batch(executor, failed_notes, notebooks_by_guid, output_directory, still_failed_notes)
+        return exported_note_count, still_failed_notes
+
     def exportNotes(self, notebooks, output_directory, export_from_dtm_timestamp):
         # Iterate over each notebook
-        failed_notes = []
+        failed_notes = self.failed_notes_from_checkpoint()
         exported_note_count = 0
+        notebooks_by_guid = {notebook.guid: notebook for notebook in notebooks}
 
         self.logger.info("The export from dtm that is used for this run is:: " + datetime.fromtimestamp(export_from_dtm_timestamp).strftime(
             "%Y-%m-%d %H:%M:%S"))
 
-        for notebook in notebooks:
-            notebook_name = notebook.name
-            self.logger.info("Processing notebook:"+ notebook_name)
-
-            # Set up note filter to retrieve all notes in the notebook
-            note_filter = NoteFilter()
-            note_filter.notebookGuid = notebook.guid
-            note_filter.updated = export_from_dtm_timestamp
-
-            # Set up result spec to retrieve the note content
-            result_spec = NotesMetadataResultSpec(includeTitle=True, includeTagGuids=True, includeUpdated=True,
-                                                  includeCreated=True)
-
-            # Retrieve the metadata for all notes in the notebook
-            offset = 0
-            page_size = 100
-            total_notes_in_notebook_exported = 0
-            while True:
-
-                notes_metadata = self.note_store.findNotesMetadata(note_filter, offset, page_size, result_spec)
-                for note_metadata in notes_metadata.notes:
-                    note_guid = note_metadata.guid
-                    note_title = note_metadata.title
-                    # The date returned from evernote has millisconed precision but we need to remove it to compare against python date from seconds
-                    note_updated_dtm = note_metadata.updated / 1000
-
-                    if note_updated_dtm < export_from_dtm_timestamp:
-                        # self.logger.info("Note "+ note_title +" was last updated " + note_updated_dtm + " before the specified datetime " + export_from_dtm_timestamp + "..Skipping...")
-                        continue
-
-                    # Retrieve the note content
-                    try:
-                        note = self.note_store.getNote(note_guid, True, True, True, True)
-                        tag_names = self.note_store.getNoteTagNames(note_guid)
-                    except Exception as e:
-                        self.logger.info("Error occurred while retrieving note["+note_title+"]")
-                        failed_notes.append(note_title)
-                        continue
-
-                    # Access note metadata
-                    note_title = note.title
-                    note_created = datetime.fromtimestamp(note.created / 1000).strftime("%Y%m%dT%H%M%SZ")
-                    note_updated = datetime.fromtimestamp(note.updated / 1000).strftime("%Y%m%dT%H%M%SZ")
-
-                    self.logger.info("Exporting note with title: "+ note_title)
+        # Note content is fetched on a bounded pool of threads while the notes are written out on this thread,
+        # in the order they were returned by Evernote, so the export output and failure accounting stay deterministic
+        with ThreadPoolExecutor(max_workers=self.note_fetch_parallelism_value, thread_name_prefix="evernote-fetch") as executor:
+            for notebook in notebooks:
+                notebook_name = notebook.name
+                if self.checkpoint.is_notebook_completed(notebook.guid):
+                    self.logger.info("Skipping notebook already exported in this run:"+ notebook_name)
+                    continue
+                self.logger.info("Processing notebook:"+ notebook_name)
+
+                # Notes handled before an interrupted run was stopped are not exported again. Several notes can share
+                # the updated time of the last one handled, so the ones among them that were handled are known by guid
+                notebook_progress = self.checkpoint.notebook_progress(notebook.guid)
+                handled_updated = notebook_progress["updated"]
+                handled_guids = set(notebook_progress["guids"])
+
+                # Set up note filter to retrieve all notes in the notebook. They are sorted oldest update first
+                # so the progress through the notebook can be checkpointed by the updated time of the last note
+                note_filter = NoteFilter()
+                note_filter.notebookGuid = notebook.guid
+                note_filter.order = NoteSortOrder.UPDATED
+                note_filter.ascending = True
+
+                # Set up result spec to retrieve the note content
+                result_spec = NotesMetadataResultSpec(includeTitle=True, includeTagGuids=True, includeUpdated=True,
+                                                      includeCreated=True)
+
+                # The notes are paged by an updated time cursor rather than by offset. A note edited during the run moves
+                # to the end of the sort order, which shifts every later note back by one and would make offset paging
+                # skip a note. Every page is searched again from the updated time of the last note handled instead
+                cursor_timestamp = max(export_from_dtm_timestamp, handled_updated // 1000)
+                offset = 0
+                page_size = 100
+                total_notes_in_notebook_exported = 0
+                while True:
+
+                    # The search grammar only has a precision of seconds, so the notes of the cursor second that were
+                    # already handled are returned again and skipped below
+                    note_filter.words = "updated:" + datetime.fromtimestamp(cursor_timestamp, timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+                    notes_metadata = self.scheduler.call(self.note_store.findNotesMetadata, note_filter, offset, page_size, result_spec)
 
-                    note_attributes = note.attributes
-
-                    # Access the Content
-                    note_content = note.content
-
-                    # Create the root element for the XML
-                    root = ET.Element("en-export")
-                    root.set("export-date", datetime.now().strftime("%Y%m%dT%H%M%SZ"))
-                    root.set("application", "Evernote")
-                    root.set("version", "10.44.8")
-
-                    # Create the note element
-                    note_elem = ET.SubElement(root, "note")
-
-                    # Create the title element
-                    title_elem = ET.SubElement(note_elem, "title")
-                    title_elem.text = f"{notebook.name} - {note_title}"
-
-                    # Create the created element
-                    created_elem = ET.SubElement(note_elem, "created")
-                    created_elem.text = note_created
-
-                    # Create the updated element
-                    updated_elem = ET.SubElement(note_elem, "updated")
-                    updated_elem.text = note_updated
+                    # The date returned from evernote has millisconed precision but we need to remove it to compare against python date from seconds
+                    notes_to_export = [note_metadata for note_metadata in notes_metadata.notes
+                                       if note_metadata.updated / 1000 >= export_from_dtm_timestamp
+                                       and (note_metadata.updated > handled_updated
+                                            or (note_metadata.updated == handled_updated and note_metadata.guid not in handled_guids))]
+
+                    notes_exported = self.export_note_batch(executor, notes_to_export, {notebook.guid: notebook}, output_directory, failed_notes)
+                    exported_note_count += notes_exported
+                    total_notes_in_notebook_exported += notes_exported
+
+                    handled_notes = notes_metadata.notes
+                    if self.flowfile_full_after is not None:
+                        # Only the notes up to the one that filled the FlowFile were handled
+                        handled_notes = handled_notes[:handled_notes.index(self.flowfile_full_after) + 1]
+                    elif len(notes_metadata.notes) < page_size:
+                        self.checkpoint.complete_notebook(notebook.guid)
+                        self.logger.info(" Finished exporting " + str(total_notes_in_notebook_exported) + " notes from notebook " + notebook.name)
+                        break
+
+                    for note_metadata in handled_notes:
+                        if note_metadata.updated > handled_updated:
+                            handled_updated = note_metadata.updated
+                            handled_guids = set()
+                        if note_metadata.updated == handled_updated:
+                            handled_guids.add(note_metadata.guid)
+                    self.checkpoint.record_notebook_progress(notebook.guid, handled_updated, handled_guids)
+                    if self.flowfile_full_after is not None:
+                        break
+
+                    if handled_updated // 1000 > cursor_timestamp:
+                        cursor_timestamp = handled_updated // 1000
+                        offset = 0
+                    else:
+                        # A whole page of notes updated within the cursor second can only be paged past by offset
+                        offset += page_size
+
+                if self.flowfile_full_after is not None:
+                    self.logger.info("The FlowFile is full. The export continues with notebook " + notebook.name + " on the next trigger")
+                    break
 
-                    # Create the tags element . If empty still have the element with just just empty value
-                    tags_elem = ET.SubElement(note_elem, "tags")
-                    if len(tag_names) == 0:
-                        tag_names = [' ']
-                    tags_elem.text = ','.join(tag_names)
+            if self.flowfile_full_after is None:
+                notes_exported, failed_notes = self.retry_failed_notes(executor, failed_notes, notebooks_by_guid, output_directory)
+                exported_note_count += notes_exported
 
-                    # Create the content element
-                    content_elem = ET.SubElement(note_elem, "content")
-                    content_elem.text = note_content
+        self.logger.info("Export completed. Number of notes exported successfuly is: "+ str(exported_note_count))
+        self.logger.info("Number of notes failed is " +  str(len(failed_notes)) + ", they are retried by the next run: " + str([note.title for note in failed_notes]))
 
-                    # Create the XML tree
-                    tree = ET.ElementTree(root)
+    def syncNotes(self, stack_filter, output_directory, export_from_dtm_timestamp, after_usn):
+        # A single getSyncState call tells us if anything in the account changed since the last run
+        sync_state = self.scheduler.call(self.note_store.getSyncState)
+        if sync_state.updateCount <= after_usn and len(self.checkpoint.failed_note_guids()) == 0:
+            self.logger.info("No changes in Evernote since update sequence number " + str(after_usn))
+            return after_usn
 
-                    # Convert the XML tree to a formatted string
-                    xml_string = minidom.parseString(ET.tostring(root)).toprettyxml(indent="  ")
+        self.logger.info("Syncing changes from update sequence number " + str(after_usn) + " to " + str(sync_state.updateCount))
 
-                    # Specify the output file path
-                    file_name = f"Notebook__{notebook.name}__Note__{note_title}__Id__{note_guid[-4:]}.enex"
+        notebooks = self.retrieve_all_notebooks(stack_filter)
+        notebooks_by_guid = {notebook.guid: notebook for notebook in notebooks}
 
-                    escaped_file_named= self.escape_filename(file_name)
-                    output_path = os.path.join(output_directory, escaped_file_named)
+        # The export from date/time only limits the initial full sync. After that every change is picked up through its USN
+        if self.checkpoint.state["run"]["started_sync_usn"] > 0:
+            export_from_dtm_timestamp = 0
 
-                    # Save the XML content to a file
-                    with open(output_path, "w", encoding="utf-8") as file:
-                        file.write(xml_string)
+        failed_notes = self.failed_notes_from_checkpoint()
+        exported_note_count = 0
 
-                    exported_note_count += 1
-                    total_notes_in_notebook_exported += 1
-                    self.logger.info("Note[" + note_title +"] in notebook["+notebook.name+"]  saved to: " + output_path)
+        # Sync chunks only carry the note metadata. The content is retrieved with getNote for the notes that changed
+        sync_chunk_filter = SyncChunkFilter(includeNotes=True)
+        with ThreadPoolExecutor(max_workers=self.note_fetch_parallelism_value, thread_name_prefix="evernote-fetch") as executor:
+            while after_usn < sync_state.updateCount:
+                sync_chunk = self.scheduler.call(self.note_store.getFilteredSyncChunk, after_usn, 100, sync_chunk_filter)
+                if sync_chunk.chunkHighUSN is None:
+                    break
 
-                if len(notes_metadata.notes) < page_size:
-                    self.logger.info(" Finished exporting " + str(total_notes_in_notebook_exported) + " notes from notebook " + notebook.name)
+                notes_to_export = [note for note in (sync_chunk.notes or [])
+                                   if note.notebookGuid in notebooks_by_guid
+                                   and note.deleted is None
+                                   and note.updated / 1000 >= export_from_dtm_timestamp]
+
+                exported_note_count += self.export_note_batch(executor, notes_to_export, notebooks_by_guid, output_directory, failed_notes)
+                if self.flowfile_full_after is not None:
+                    # The notes of a chunk are in USN order, so the next trigger syncs the rest of the chunk from this note
+                    after_usn = self.flowfile_full_after.updateSequenceNum
+                    self.checkpoint.record_sync_usn(after_usn)
+                    self.logger.info("The FlowFile is full. The sync continues from update sequence number " + str(after_usn) + " on the next trigger")
                     break
-                offset += page_size
+                after_usn = sync_chunk.chunkHighUSN
+                self.checkpoint.record_sync_usn(after_usn)
 
-        self.logger.info("Export completed. Number of notes exported successfuly is: "+ str(exported_note_count))
-        self.logger.info("Number of notes failed is " +  str(len(failed_notes)))
+            if self.flowfile_full_after is None:
+                notes_exported, failed_notes = self.retry_failed_notes(executor, failed_notes, notebooks_by_guid, output_directory)
+                exported_note_count += notes_exported
 
+        self.logger.info("Sync completed up to update sequence number " + str(after_usn) + ". Number of notes exported successfuly is: "+ str(exported_note_count))
+        self.logger.info("Number of notes failed is " +  str(len(failed_notes)) + ", they are retried by the next run: " + str([note.title for note in failed_notes]))
+        return after_usn
 
     def transform(self, context, flowFile):
 
         self.logger.info("Inside Transform of ExportNOtesFromEvernote....")
         # Capture the current date/time for moving time window
         current_dtm = datetime.now()
-        #Fetch all the note notebooks in the account
-        stack_filter = context.getProperty(self.stack_filter.name).getValue()
 
-        notebooks = self.retrieve_all_notebooks(stack_filter)
-        self.logger.info("Number of notebooks in  account is: " + str(len(notebooks)))
+        # Start a new run in the checkpoint or pick up the one that was interrupted along with its window
+        run = self.checkpoint.begin_run(int(current_dtm.timestamp()), self.export_from_dtm_timestamp_window)
+        if run["started"] != int(current_dtm.timestamp()):
+            self.logger.info("Resuming the interrupted export run that started at: " + datetime.fromtimestamp(run["started"]).strftime("%Y-%m-%d %H:%M:%S"))
+        export_from_dtm_timestamp = run["export_from_timestamp"]
 
-        output_directory = context.getProperty(self.export_directory.name).getValue()
+        # All the Evernote API calls of the run go through the scheduler so they back off together when rate limited
+        self.scheduler = RateLimitScheduler(self.logger, self.max_rate_limit_wait_value)
 
-        self.exportNotes(notebooks, output_directory, self.export_from_dtm_timestamp_window)
+        self.run_exported_note_count = 0
+        self.run_unchanged_note_count = 0
 
-        # Update the export from date once the the export run is complete. Convert datetime and then to  timestamp
-        self.export_from_dtm_timestamp_window = int(current_dtm.timestamp())
+        # Drop the content hashes recorded by a run that failed before it handed over its notes
+        if self.content_hash_index is not None:
+            self.content_hash_index.rollback()
 
-        return FlowFileTransformResult(relationship="success")
+        #Fetch all the note notebooks in the account
+        stack_filter = context.getProperty(self.stack_filter.name).getValue()
+        output_directory = context.getProperty(self.export_directory.name).getValue()
+
+        # When the notes are written to the FlowFile content they are collected in a single enex document. Once it is
+        # full the run stops at the note that filled it
+        self.flowfile_enex = None
+        self.flowfile_full_after = None
+        if self.output_destination_value == 'FlowFile Content':
+            self.flowfile_enex = EnexFlowFileWriter(self.notes_per_flowfile_value, self.max_bytes_per_export_file, self.export_compression_value)
+
+        # Batched notes are packed into multi-note enex files. The progress is saved every time a batch file is completed
+        self.enex_batch_writer = None
+        if self.flowfile_enex is None and self.notes_per_export_file_value != 1:
+            # Remove the batch files a failed run did not complete. Their notes are exported again by this run
+            for stale_batch_file in glob.glob(os.path.join(output_directory, ".Evernote_Export__*.part")):
+                os.remove(stale_batch_file)
+            self.enex_batch_writer = EnexBatchWriter(output_directory, "Evernote_Export__" + current_dtm.strftime("%Y%m%dT%H%M%S"),
+                                                     self.notes_per_export_file_value, self.max_bytes_per_export_file,
+                                                     self.export_compression_value, self.save_batch_progress)
+
+        # Tags are loaded the first time a note in this run needs them
+        self.tag_names_by_guid = None
+        self.unresolved_tag_guids = set()
+
+        export_mode = context.getProperty(self.export_mode.name).getValue()
+        try:
+            if export_mode == 'Incremental Sync (USN)':
+                self.last_sync_usn = self.syncNotes(stack_filter, output_directory, export_from_dtm_timestamp, self.last_sync_usn)
+            else:
+                notebooks = self.retrieve_all_notebooks(stack_filter)
+                self.logger.info("Number of notebooks in  account is: " + str(len(notebooks)))
+
+                self.exportNotes(notebooks, output_directory, export_from_dtm_timestamp)
+
+            if self.enex_batch_writer is not None:
+                self.enex_batch_writer.close()
+
+            contents = None
+            if self.flowfile_enex is not None:
+                contents = self.flowfile_enex.close()
+        except Exception:
+            # The run stays open in the checkpoint and the next run resumes it
+            self.discard_run_progress()
+            raise
+
+        # The progress is saved only once the notes of the run are written out, right before they are handed over
+        run_complete = self.flowfile_full_after is None
+        if run_complete:
+            # Update the export from date once the the export run is complete. It is persisted in the checkpoint
+            self.checkpoint.complete_run()
+        else:
+            # The run stays open and the next trigger resumes it after the notes handed over in this FlowFile
+            self.checkpoint.save()
+        if self.content_hash_index is not None:
+            self.content_hash_index.commit()
+        self.export_from_dtm_timestamp_window = self.checkpoint.state["export_from_timestamp"]
+
+        throttled_seconds = round(self.scheduler.throttled_seconds, 3)
+        self.logger.info("Time the export spent paused by the Evernote rate limit in seconds: " + str(throttled_seconds))
+
+        attributes = {"evernote.export.throttled.seconds": str(throttled_seconds),
+                      "evernote.export.note.count": str(self.run_exported_note_count),
+                      "evernote.export.unchanged.count": str(self.run_unchanged_note_count),
+                      "evernote.export.run.complete": str(run_complete).lower()}
+
+        if self.flowfile_enex is not None and self.flowfile_enex.note_count == 0:
+            # Nothing to export, so no empty enex document is sent to success. The result goes to original instead
+            return FlowFileTransformResult(relationship="original", attributes=attributes)
+
+        if contents is not None:
+            attributes["filename"] = "Evernote_Export__" + current_dtm.strftime("%Y%m%dT%H%M%S") + ".enex" + COMPRESSION_EXTENSIONS[self.export_compression_value]
+            attributes["mime.type"] = {'None': "application/enex+xml", 'gzip': "application/gzip", 'zstd': "application/zstd"}[self.export_compression_value]
+            return FlowFileTransformResult(relationship="success", contents=contents, attributes=attributes)
+
+        return FlowFileTransformResult(relationship="success", attributes=attributes)
 
 
     def getPropertyDescriptors(self):
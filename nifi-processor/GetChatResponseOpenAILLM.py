@@ -23,9 +23,9 @@ from nifiapi.properties import PropertyDescriptor
 from nifiapi.properties import StandardValidators
 from nifiapi.properties import ExpressionLanguageScope
 from nifiapi.flowfiletransform import FlowFileTransform, FlowFileTransformResult
+from vector_embedding_utils import create_embedding_service
 
 from langchain.vectorstores import Pinecone
-from langchain.embeddings import OpenAIEmbeddings
 import pinecone
 from langchain.chains import ConversationalRetrievalChain
 from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
@@ -35,7 +35,7 @@ class GetChatResponseOpenAILLM(FlowFileTransform):
     class Java:
         implements = ['org.apache.nifi.python.processor.FlowFileTransform']
     class ProcessorDetails:
-        dependencies = ['langchain', 'openai', 'pinecone-client','tiktoken']
+        dependencies = ['langchain', 'openai', 'pinecone-client','tiktoken', 'numpy']
         version = '0.0.1-SNAPSHOT'
         description = 'Performs a similarity search in Pinecone based on the query/question that is asked and returns list of similar text docs with metadata.'
         tags = ['Pinecone','OpenAI', 'AI', 'Vector Similarity Search', 'Vector Database']
@@ -65,6 +65,31 @@ class GetChatResponseOpenAILLM(FlowFileTransform):
             default_value = "text-embedding-ada-002",
             allowable_values = ['text-embedding-ada-002', 'text-davinci-001', 'text-curie-001', 'text-babbage-001', 'text-ada-001']
         )
+        self.embedding_provider = PropertyDescriptor(
+            name="Embedding Provider",
+            description="Where the query/question is embedded. Use the same provider and model GetOpenAiVectorEmbedding created the vectors of the index with",
+            default_value = "OpenAI",
+            required = True,
+            allowable_values = ['OpenAI', 'Local Sentence Transformers']
+        )
+        self.local_embedding_model = PropertyDescriptor(
+            name="Local Embedding Model",
+            description="The local path of the sentence-transformers model directory, or the name of a model in the local huggingface cache, used when the Embedding Provider is Local Sentence Transformers",
+            default_value = "sentence-transformers/all-MiniLM-L6-v2",
+            required = False
+        )
+        self.pca_projection_file = PropertyDescriptor(
+            name="PCA Projection File",
+            description="The PCA Projection File GetOpenAiVectorEmbedding projected the vectors of the index with. The query embedding is projected the same way",
+            required = False
+        )
+        self.embedding_quantization = PropertyDescriptor(
+            name="Embedding Quantization",
+            description="The Embedding Quantization GetOpenAiVectorEmbedding quantized the vectors of the index with. The query embedding is quantized the same way",
+            default_value = "None",
+            required = True,
+            allowable_values = ['None', 'int8']
+        )
 
         self.openai_llm_temperature= PropertyDescriptor(
             name="LLM temperature",
@@ -128,7 +153,7 @@ class GetChatResponseOpenAILLM(FlowFileTransform):
             required = True,
         )
 
-        self.descriptors = [self.openai_api_key, self.openai_llm_model, self.openai_embedding_model, self.openai_llm_temperature, self.question, self.chat_history, self.pinecone_api_key, self.pinecone_environment_name, self.pinecone_index_name, self.pinecone_namespace, self.user, self.search_results_size]
+        self.descriptors = [self.openai_api_key, self.openai_llm_model, self.openai_embedding_model, self.embedding_provider, self.local_embedding_model, self.pca_projection_file, self.embedding_quantization, self.openai_llm_temperature, self.question, self.chat_history, self.pinecone_api_key, self.pinecone_environment_name, self.pinecone_index_name, self.pinecone_namespace, self.user, self.search_results_size]
 
     def onScheduled(self, context):
         self.logger.info("Initializing OpenAI and Pinecone Services.")
@@ -136,7 +161,10 @@ class GetChatResponseOpenAILLM(FlowFileTransform):
         # Get the properties from the processor needed to configure the OpenAI Embedding Service
         openai_api_key = context.getProperty(self.openai_api_key.name).getValue()
         embeddings_model_name = context.getProperty(self.openai_embedding_model.name).getValue()
-        openai_embedding_service = OpenAIEmbeddings(openai_api_key=openai_api_key, model=embeddings_model_name)
+        openai_embedding_service = create_embedding_service(context.getProperty(self.embedding_provider.name).getValue(), openai_api_key, embeddings_model_name,
+                                                            context.getProperty(self.local_embedding_model.name).getValue(),
+                                                            context.getProperty(self.pca_projection_file.name).getValue(),
+                                                            context.getProperty(self.embedding_quantization.name).getValue())
 
         # Initialize Pinecone and get the index we will be upserting into.
         pinecone_api_key =  context.getProperty(self.pinecone_api_key.name).getValue()
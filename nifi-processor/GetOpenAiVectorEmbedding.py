@@ -13,31 +13,216 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import functools
+import hashlib
 import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+from array import array
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+import msgpack
+import numpy
+import openai
+import tiktoken
 from nifiapi.properties import PropertyDescriptor
 from nifiapi.properties import StandardValidators
 from nifiapi.properties import ExpressionLanguageScope
 from nifiapi.flowfiletransform import FlowFileTransform, FlowFileTransformResult
+from vector_embedding_utils import ChunkDedupeStore, is_json_content, load_pca_projection, transform_embeddings, unpack_embedding
+
+
+# The most tokens a single text can have for the OpenAI embedding models
+EMBEDDING_CONTEXT_LENGTH = 8191
+
+# The errors a single text of a request can cause. The texts of a batch rejected with one are retried one by one. Any
+# other error, like an invalid key or a rate limit that outlasted the retries, would fail every request the same way
+TEXT_ERRORS = (openai.error.InvalidRequestError,)
+
+def chunk_hash(model_name, text):
+    # Chunks that only differ in whitespace or unicode normalization have the same hash
+    normalized_text = re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+    return hashlib.sha256((model_name + "\x00" + normalized_text).encode("utf-8")).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def get_model_encoding(model_name):
+    # Loading an encoding reads its BPE ranks, so it is only done once per python worker
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def pack_token_batches(token_counts, max_texts, max_tokens):
+    # Packs the texts, in order, into batches of at most max_texts texts and max_tokens tokens. Returns the (start, end)
+    # index ranges of the batches. A text with more tokens than max_tokens gets a batch of its own
+    batches = []
+    start = 0
+    batch_tokens = 0
+    for index, token_count in enumerate(token_counts):
+        if index > start and (index - start >= max_texts or batch_tokens + token_count > max_tokens):
+            batches.append((start, index))
+            start = index
+            batch_tokens = 0
+        batch_tokens += token_count
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+
+class TokenBucketRateLimiter:
+    # Keeps the embedding requests within the requests per minute and tokens per minute of the OpenAI account. Both buckets
+    # hold a minute of their rate and are refilled continuously. When OpenAI still answers with a 429, every request is
+    # paused for the backoff before it is sent.
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.updated = time.monotonic()
+        self.resume_at = 0
+        self.blocked_until = 0
+        self.throttled_seconds = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        # A request with more tokens than a minute's worth waits for a full bucket
+        tokens = min(tokens, self.token_capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.updated
+                self.updated = now
+                self.available_requests = min(self.request_capacity, self.available_requests + elapsed * self.request_capacity / 60)
+                self.available_tokens = min(self.token_capacity, self.available_tokens + elapsed * self.token_capacity / 60)
+
+                wait = max(self.resume_at - now,
+                           (1 - self.available_requests) * 60 / self.request_capacity,
+                           (tokens - self.available_tokens) * 60 / self.token_capacity)
+                if wait <= 0:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                # Only count the part of the wait that is not already covered by the wait of another request, so the
+                # throttled time is the wall clock time the bucket held the requests back
+                if now + wait > self.blocked_until:
+                    self.throttled_seconds += now + wait - max(self.blocked_until, now)
+                    self.blocked_until = now + wait
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+
+class EmbeddingCache:
+    # Local sqlite cache of the embeddings created before, keyed by the hash of the embedding model and the exact text.
+    # The embeddings are stored as the float32 buffers they are passed around as. Once the cache holds more than max_entries embeddings, the least
+    # recently used ones are evicted.
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embedding (text_hash TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used INTEGER NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embedding_last_used ON embedding (last_used)")
+        self.connection.commit()
+
+    @staticmethod
+    def text_hash(model_name, text):
+        return hashlib.sha256((model_name + "\x00" + text).encode("utf-8")).hexdigest()
+
+    def get(self, text_hashes):
+        # Returns the cached float32 buffers by text hash and marks them as used
+        cached = {}
+        for i in range(0, len(text_hashes), 500):
+            batch = text_hashes[i:i + 500]
+            rows = self.connection.execute("SELECT text_hash, embedding FROM embedding WHERE text_hash IN (" + ",".join("?" * len(batch)) + ")", batch)
+            cached.update(rows.fetchall())
+        now = time.time_ns()
+        self.connection.executemany("UPDATE embedding SET last_used = ? WHERE text_hash = ?", [(now, text_hash) for text_hash in cached])
+        self.connection.commit()
+        self.hits += len(cached)
+        self.misses += len(text_hashes) - len(cached)
+        return cached
+
+    def put(self, embeddings_by_text_hash):
+        now = time.time_ns()
+        self.connection.executemany("INSERT OR REPLACE INTO embedding (text_hash, embedding, last_used) VALUES (?, ?, ?)",
+                                    [(text_hash, embedding, now) for text_hash, embedding in embeddings_by_text_hash.items()])
+        entries = self.connection.execute("SELECT COUNT(*) FROM embedding").fetchone()[0]
+        if entries > self.max_entries:
+            self.connection.execute("DELETE FROM embedding WHERE text_hash IN (SELECT text_hash FROM embedding ORDER BY last_used LIMIT ?)", (entries - self.max_entries,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def write_failed_chunks(directory, failed_chunks, as_json):
+    # The chunks that could not be embedded are written in the format they came in, so the file can be fed back to the
+    # processor as it is. The file is written under a hidden name and renamed once complete, so ListFile never picks up half of it
+    file_name = "Embedding_Failures__" + str(time.time_ns()) + "__" + uuid.uuid4().hex[:8] + (".json" if as_json else ".msgpack")
+    part_path = os.path.join(directory, "." + file_name + ".part")
+    with open(part_path, "wb") as file:
+        file.write(json.dumps(failed_chunks).encode('utf-8') if as_json else msgpack.packb(failed_chunks))
+    path = os.path.join(directory, file_name)
+    os.replace(part_path, path)
+    return path
+
+
+class SentenceTransformerEmbeddingModel:
+    # A sentence-transformers model loaded from a local path, or by name from the local huggingface cache, that creates the
+    # embeddings on the CPU without calling out to OpenAI. sentence-transformers is only imported when the Local provider is
+    # used, it has to be installed in the python environment of the processor.
+
+    def __init__(self, model_name_or_path, batch_size, device):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name_or_path, device=device)
+        self.batch_size = batch_size
+
+    def embed(self, texts):
+        # The embeddings are normalized like the OpenAI ones, so the cosine and dot product metrics of the index agree, and
+        # returned as the same little-endian float32 buffers
+        vector_embeddings = self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True, normalize_embeddings=True,
+                                              show_progress_bar=False)
+        return [vector_embedding.astype('<f4').tobytes() for vector_embedding in vector_embeddings]
 
-from langchain.embeddings import OpenAIEmbeddings
 
 class GetOpenAiVectorEmbedding(FlowFileTransform):
     class Java:
         implements = ['org.apache.nifi.python.processor.FlowFileTransform']
     class ProcessorDetails:
-        dependencies = ['langchain', 'openai','tiktoken']
+        dependencies = ['openai<1','tiktoken', 'msgpack', 'numpy']
         version = '0.0.1-SNAPSHOT'
-        description = 'Creates text embeddings for each text chunk using OpeanAI embedding model services using langchain libraries'
-        tags = ['AI', 'OpenAI',  'Embeddings', 'Langchain', 'Vectors' ]
+        description = 'Creates text embeddings for each text chunk using OpeanAI embedding model services or a local sentence-transformers model'
+        tags = ['AI', 'OpenAI',  'Embeddings', 'Vectors' ]
 
 
     def __init__(self, **kwargs):
         # Build Property Descriptors
 
+        self.embedding_provider = PropertyDescriptor(
+            name="Embedding Provider",
+            description="Where the embeddings are created. OpenAI sends the texts to the OpenAI embedding model, Local Sentence Transformers runs the Local Embedding Model on the CPU of the NiFi node, so the ingestion can run fully offline. The vectors of the two providers have different dimensions and can not share a Pinecone index",
+            default_value = "OpenAI",
+            required = True,
+            allowable_values = ['OpenAI', 'Local Sentence Transformers']
+        )
         self.openai_api_key = PropertyDescriptor(
             name="OpenAI API Key",
-            description="The API key to connect to OpeanAI services",
-            required = True,
+            description="The API key to connect to OpeanAI services. Required when the Embedding Provider is OpenAI",
+            required = False,
             sensitive = True
         )
         self.openai_embedding_model = PropertyDescriptor(
@@ -47,15 +232,110 @@ class GetOpenAiVectorEmbedding(FlowFileTransform):
             default_value = "text-embedding-ada-002",
             allowable_values = ['text-embedding-ada-002', 'text-davinci-001', 'text-curie-001', 'text-babbage-001', 'text-ada-001']
         )
+        self.local_embedding_model = PropertyDescriptor(
+            name="Local Embedding Model",
+            description="The local path of the sentence-transformers model directory, or the name of a model in the local huggingface cache, used when the Embedding Provider is Local Sentence Transformers. Set the same model on GetPineconeVectorSemanticSearch and GetChatResponseOpenAILLM so the queries are embedded like the notes",
+            default_value = "sentence-transformers/all-MiniLM-L6-v2",
+            required = False
+        )
+        self.local_batch_size = PropertyDescriptor(
+            name="Local Batch Size",
+            description="The number of texts the Local Embedding Model embeds in one batch",
+            default_value = "32",
+            required = True,
+            validators=[StandardValidators.POSITIVE_INTEGER_VALIDATOR]
+        )
         self.chunk_size = PropertyDescriptor(
             name="Chunk Size",
-            description="The number of characters that each text chunk when used by OpenAI to create the text embedding",
+            description="The maximum number of texts sent to OpenAI in a single embedding request",
             default_value = 1000,
             required = True,
         )
+        self.max_tokens_per_request = PropertyDescriptor(
+            name="Max Tokens per Request",
+            description="The texts are packed into embedding requests of up to this many tokens. The token counts SplitEvernoteText adds to the chunks are used when present, otherwise the texts are tokenized with the encoding of the model",
+            default_value = "100000",
+            required = True,
+            validators=[StandardValidators.POSITIVE_INTEGER_VALIDATOR]
+        )
+        self.max_concurrent_requests = PropertyDescriptor(
+            name="Max Concurrent Requests",
+            description="The number of embedding requests sent to OpenAI at the same time",
+            default_value = "4",
+            required = True,
+            validators=[StandardValidators.POSITIVE_INTEGER_VALIDATOR]
+        )
+        self.max_requests_per_minute = PropertyDescriptor(
+            name="Max Requests per Minute",
+            description="The embedding requests per minute of the OpenAI account. Requests are held back so the rate is not exceeded",
+            default_value = "3000",
+            required = True,
+            validators=[StandardValidators.POSITIVE_INTEGER_VALIDATOR]
+        )
+        self.max_tokens_per_minute = PropertyDescriptor(
+            name="Max Tokens per Minute",
+            description="The embedding tokens per minute of the OpenAI account. Requests are held back so the rate is not exceeded",
+            default_value = "1000000",
+            required = True,
+            validators=[StandardValidators.POSITIVE_INTEGER_VALIDATOR]
+        )
+        self.max_rate_limit_retries = PropertyDescriptor(
+            name="Max Rate Limit Retries",
+            description="The number of times a request is retried with an exponential backoff when OpenAI answers that the rate limit is reached, that it is overloaded or with a transient error",
+            default_value = "6",
+            required = True,
+            validators=[StandardValidators.NON_NEGATIVE_INTEGER_VALIDATOR]
+        )
+
+        self.output_format = PropertyDescriptor(
+            name="Output Format",
+            description="The format of the text embeddings written to the FlowFile content. MessagePack writes every embedding as the little-endian float32 buffer OpenAI returns, JSON as a list of floats. The incoming chunks are read as JSON or MessagePack whichever they are in",
+            default_value = "JSON",
+            required = True,
+            allowable_values = ['JSON', 'MessagePack']
+        )
+
+        self.chunk_dedupe_store_file = PropertyDescriptor(
+            name="Chunk Dedupe Store File",
+            description="The full path of a sqlite file of the chunks whose vectors were already upserted. When set, chunks whose normalized text was already embedded with the same model for the same source note are dropped, so only new or changed chunks are embedded and passed on. Set the same file on PutPineconeVectorEmbedding, which records the chunks once they are upserted. Use one file per Pinecone index and namespace",
+            required = False
+        )
+
+        self.embedding_cache_file = PropertyDescriptor(
+            name="Embedding Cache File",
+            description="The full path of a sqlite file that caches the embeddings created before by model and text. When set, only the texts that are not in the cache are sent to OpenAI, so backfills, replays and re-exports do not pay for the same embeddings again",
+            required = False
+        )
+        self.pca_projection_file = PropertyDescriptor(
+            name="PCA Projection File",
+            description="The full path of a numpy .npz file with the mean and the principal components fitted on the embeddings of the corpus, see testing/embedding-compression-benchmark.py. When set, the embeddings are projected onto the components and normalized, so the Pinecone index only needs as many dimensions as there are components. Set the same file on GetPineconeVectorSemanticSearch and GetChatResponseOpenAILLM",
+            required = False
+        )
+        self.embedding_quantization = PropertyDescriptor(
+            name="Embedding Quantization",
+            description="int8 quantizes every embedding, after the PCA projection when there is one, to a byte per dimension along with a scale per embedding, written as embedding_scale. PutPineconeVectorEmbedding scales the codes back to floats, as Pinecone stores float vectors, so it shrinks the FlowFile content rather than the index. Set the same quantization on GetPineconeVectorSemanticSearch and GetChatResponseOpenAILLM",
+            default_value = "None",
+            required = True,
+            allowable_values = ['None', 'int8']
+        )
+        self.failed_chunk_directory = PropertyDescriptor(
+            name="Failed Chunk Directory",
+            description="The directory the chunks that could not be embedded are written to, along with the reason, once their batch and then every text of it on its own were retried. The embedded chunks continue on success without them and the file can be fed back to the processor with ListFile and FetchFile. When not set, a FlowFile with chunks that could not be embedded is routed to failure as a whole, and the embeddings that were created are kept in the Embedding Cache File, when set, so the retry does not pay for them again",
+            required = False
+        )
+        self.embedding_cache_max_entries = PropertyDescriptor(
+            name="Embedding Cache Max Entries",
+            description="The number of embeddings the Embedding Cache File holds before the least recently used ones are evicted. A 1536 dimension embedding takes about 6 KB",
+            default_value = "100000",
+            required = True,
+            validators=[StandardValidators.POSITIVE_INTEGER_VALIDATOR]
+        )
 
-        self.descriptors = [self.openai_api_key, self.openai_embedding_model, self.chunk_size ]
-        self.openai_embedding_service = None
+        self.descriptors = [self.embedding_provider, self.openai_api_key, self.openai_embedding_model, self.local_embedding_model, self.local_batch_size, self.chunk_size, self.max_tokens_per_request, self.max_concurrent_requests, self.max_requests_per_minute, self.max_tokens_per_minute, self.max_rate_limit_retries, self.output_format, self.chunk_dedupe_store_file, self.embedding_cache_file, self.embedding_cache_max_entries, self.failed_chunk_directory, self.pca_projection_file, self.embedding_quantization ]
+        self.chunk_dedupe_store = None
+        self.embedding_cache = None
+        self.request_executor = None
+        self.local_model = None
 
     def onScheduled(self, context):
         self.logger.info("Initializing OpenAI Embedding Service")
@@ -64,47 +344,348 @@ class GetOpenAiVectorEmbedding(FlowFileTransform):
         openai_api_key = context.getProperty(self.openai_api_key.name).getValue()
         model_name = context.getProperty(self.openai_embedding_model.name).getValue()
 
-        # Initialize OpenAI Embedding Service
-        self.openai_embedding_service = OpenAIEmbeddings(openai_api_key=openai_api_key, model=model_name)
+        # The local model is loaded once. Its name takes the place of the OpenAI model in the cache and dedupe keys
+        # and in the metadata of the vectors
+        self.local_model = None
+        if context.getProperty(self.embedding_provider.name).getValue() == 'Local Sentence Transformers':
+            model_name = context.getProperty(self.local_embedding_model.name).getValue()
+            self.logger.info("Loading the local embedding model " + model_name)
+            self.local_model = SentenceTransformerEmbeddingModel(model_name, context.getProperty(self.local_batch_size.name).asInteger(), "cpu")
+        elif openai_api_key is None or openai_api_key == '':
+            raise ValueError("The OpenAI API Key is required when the Embedding Provider is OpenAI")
+
+        # Initialize OpenAI Embedding Service. The requests are sent from a pool of threads and held back by the rate limiter
+        self.openai_api_key_value = openai_api_key
+        self.model_name = model_name
+        self.max_tokens_per_request_value = context.getProperty(self.max_tokens_per_request.name).asInteger()
+        self.max_rate_limit_retries_value = context.getProperty(self.max_rate_limit_retries.name).asInteger()
+        self.rate_limiter = TokenBucketRateLimiter(context.getProperty(self.max_requests_per_minute.name).asInteger(),
+                                                   context.getProperty(self.max_tokens_per_minute.name).asInteger())
+        self.request_executor = ThreadPoolExecutor(max_workers=context.getProperty(self.max_concurrent_requests.name).asInteger())
+
+        chunk_dedupe_store_file = context.getProperty(self.chunk_dedupe_store_file.name).getValue()
+        self.chunk_dedupe_store = None
+        if chunk_dedupe_store_file is not None and chunk_dedupe_store_file != '':
+            self.chunk_dedupe_store = ChunkDedupeStore(chunk_dedupe_store_file)
+
+        embedding_cache_file = context.getProperty(self.embedding_cache_file.name).getValue()
+        self.embedding_cache = None
+        if embedding_cache_file is not None and embedding_cache_file != '':
+            self.embedding_cache = EmbeddingCache(embedding_cache_file, context.getProperty(self.embedding_cache_max_entries.name).asInteger())
 
+        # The embeddings are cached as they come from the model, so the cache stays valid when the transform changes
+        pca_projection_file = context.getProperty(self.pca_projection_file.name).getValue()
+        self.pca_projection = None
+        if pca_projection_file is not None and pca_projection_file != '':
+            self.pca_projection = load_pca_projection(pca_projection_file)
+        self.embedding_quantization_value = context.getProperty(self.embedding_quantization.name).getValue()
+        embedding_transforms = []
+        if self.pca_projection is not None:
+            embedding_transforms.append("pca" + str(self.pca_projection[1].shape[0]))
+        if self.embedding_quantization_value == 'int8':
+            embedding_transforms.append("int8")
+        self.embedding_transform_name = "+".join(embedding_transforms)
+
+        self.failed_chunk_directory_value = context.getProperty(self.failed_chunk_directory.name).getValue()
+        if self.failed_chunk_directory_value is not None and self.failed_chunk_directory_value != '':
+            os.makedirs(self.failed_chunk_directory_value, exist_ok=True)
+        else:
+            self.failed_chunk_directory_value = None
+
+    def onStopped(self, context):
+        if self.chunk_dedupe_store is not None:
+            self.chunk_dedupe_store.close()
+            self.chunk_dedupe_store = None
+        if self.embedding_cache is not None:
+            self.embedding_cache.close()
+            self.embedding_cache = None
+        if self.request_executor is not None:
+            self.request_executor.shutdown(wait=True, cancel_futures=True)
+            self.request_executor = None
+        self.local_model = None
+
+    def create_embeddings(self, batch_number, texts, token_count):
+        # Send one embedding request, retrying with an exponential backoff while OpenAI is rate limiting, overloaded or failing transiently
+        retries = 0
+        while True:
+            self.rate_limiter.acquire(token_count)
+            start = time.perf_counter()
+            try:
+                # The embeddings are requested base64 encoded and kept as their float32 buffers, one object per embedding
+                response = openai.Embedding.create(input=texts, model=self.model_name, api_key=self.openai_api_key_value, encoding_format="base64")
+            except (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.APIError, openai.error.APIConnectionError,
+                    openai.error.Timeout, openai.error.TryAgain) as e:
+                if retries >= self.max_rate_limit_retries_value:
+                    raise
+                # Honor the Retry-After header of a 429 when there is one
+                backoff = min(60, 2 ** retries) + random.uniform(0, 1)
+                if e.headers is not None and e.headers.get("retry-after") is not None:
+                    backoff = max(backoff, float(e.headers.get("retry-after")))
+                self.logger.warn("Embedding batch " + str(batch_number) + " was rejected with " + str(e.http_status) + " " + str(e) + ". Retrying in " + str(round(backoff, 1)) + " seconds")
+                self.rate_limiter.pause(backoff)
+                retries += 1
+                continue
+
+            latency = time.perf_counter() - start
+            self.logger.info("Embedding batch " + str(batch_number) + ": " + str(len(texts)) + " texts, " + str(response["usage"]["total_tokens"]) +
+                             " tokens, " + str(round(latency * 1000)) + " ms")
+            return [base64.b64decode(item["embedding"]) for item in sorted(response["data"], key=lambda item: item["index"])], response["usage"]["total_tokens"]
+
+    def embed_with_openai(self, texts, token_counts, max_texts):
+        # Pack the texts into requests by their token counts and keep up to Max Concurrent Requests of them in flight
+        encoding = None
+        if None in token_counts or max(token_counts) > EMBEDDING_CONTEXT_LENGTH:
+            encoding = get_model_encoding(self.model_name)
+        texts = list(texts)
+        token_counts = list(token_counts)
+        for index, text in enumerate(texts):
+            if self.model_name.endswith("001"):
+                # Newlines hurt the embeddings of the first generation models
+                texts[index] = text = text.replace("\n", " ")
+            if token_counts[index] is None or token_counts[index] > EMBEDDING_CONTEXT_LENGTH:
+                tokens = encoding.encode(text, disallowed_special=())
+                token_counts[index] = len(tokens)
+                if len(tokens) > EMBEDDING_CONTEXT_LENGTH:
+                    self.logger.warn("A text of " + str(len(tokens)) + " tokens is truncated to the " + str(EMBEDDING_CONTEXT_LENGTH) + " tokens of the embedding model")
+                    texts[index] = encoding.decode(tokens[:EMBEDDING_CONTEXT_LENGTH])
+                    token_counts[index] = EMBEDDING_CONTEXT_LENGTH
+
+        batches = pack_token_batches(token_counts, max_texts, self.max_tokens_per_request_value)
+        futures = [self.request_executor.submit(self.create_embeddings, batch_number + 1, texts[start:end], sum(token_counts[start:end]))
+                   for batch_number, (start, end) in enumerate(batches)]
+        self.request_batches += len(batches)
+        vector_embeddings = []
+        failures = {}
+        fatal_error = None
+        for batch_number, ((start, end), future) in enumerate(zip(batches, futures)):
+            try:
+                batch_embeddings, batch_tokens = future.result()
+                vector_embeddings.extend(batch_embeddings)
+                self.request_tokens += batch_tokens
+                continue
+            except CancelledError:
+                error = fatal_error
+            except TEXT_ERRORS as e:
+                error = e
+                if fatal_error is None:
+                    # The batches that succeeded are kept. The texts of a failed batch are retried on their own, so a single
+                    # text OpenAI rejects does not take the rest of the batch with it
+                    self.logger.warn("Embedding batch " + str(batch_number + 1) + " of " + str(end - start) + " texts failed: " + str(e) + ". Retrying its texts one by one")
+                    batch_embeddings, fatal_error = self.retry_texts(batch_number + 1, texts[start:end], token_counts[start:end], start, failures, e)
+                    vector_embeddings.extend(batch_embeddings)
+                    if fatal_error is not None:
+                        self.cancel_requests(futures)
+                    continue
+            except Exception as e:
+                error = e
+                if fatal_error is None:
+                    self.logger.error("Embedding batch " + str(batch_number + 1) + " failed: " + str(e) + ". The rest of the texts are failed without sending them")
+                    fatal_error = e
+                    self.cancel_requests(futures)
+            vector_embeddings.extend([None] * (end - start))
+            for index in range(start, end):
+                failures[index] = str(error)
+        return vector_embeddings, failures
+
+    def retry_texts(self, batch_number, texts, token_counts, offset, failures, batch_error):
+        # Returns the embeddings of the texts, None for the ones that failed, along with the error that fails the rest of
+        # the texts when one that does not depend on the text came up
+        if len(texts) == 1:
+            failures[offset] = str(batch_error)
+            return [None], None
+        futures = [self.request_executor.submit(self.create_embeddings, batch_number, [text], token_count) for text, token_count in zip(texts, token_counts)]
+        self.request_batches += len(futures)
+        vector_embeddings = []
+        fatal_error = None
+        for index, future in enumerate(futures):
+            try:
+                text_embeddings, text_tokens = future.result()
+                vector_embeddings.extend(text_embeddings)
+                self.request_tokens += text_tokens
+                continue
+            except CancelledError:
+                error = fatal_error
+            except TEXT_ERRORS as e:
+                error = e
+            except Exception as e:
+                error = e
+                if fatal_error is None:
+                    self.logger.error("A text of embedding batch " + str(batch_number) + " failed: " + str(e) + ". The rest of the texts are failed without sending them")
+                    fatal_error = e
+                    self.cancel_requests(futures)
+            failures[offset + index] = str(error)
+            vector_embeddings.append(None)
+        return vector_embeddings, fatal_error
+
+    def cancel_requests(self, futures):
+        # The requests that were not sent yet are dropped. The ones in flight are still waited for
+        for future in futures:
+            future.cancel()
+
+    def embed_with_provider(self, texts, token_counts, max_texts):
+        # Returns the embeddings, None in place of the texts that could not be embedded, along with the failure reasons by text index
+        if self.local_model is not None:
+            return self.local_model.embed(texts), {}
+        return self.embed_with_openai(texts, token_counts, max_texts)
+
+    def embed_texts(self, texts, token_counts, chunk_size):
+        if self.embedding_cache is None:
+            return self.embed_with_provider(texts, token_counts, chunk_size)
+
+        # Only the texts that are not in the cache are embedded
+        text_hashes = [EmbeddingCache.text_hash(self.model_name, text) for text in texts]
+        cached = self.embedding_cache.get(text_hashes)
+        missed_texts = {}
+        missed_token_counts = {}
+        for text_hash, text, token_count in zip(text_hashes, texts, token_counts):
+            if text_hash not in cached:
+                missed_texts[text_hash] = text
+                missed_token_counts[text_hash] = token_count
+        self.logger.info("Embedding cache hits: " + str(len(texts) - len(missed_texts)) + ", misses: " + str(len(missed_texts)) +
+                         " (total hits: " + str(self.embedding_cache.hits) + ", total misses: " + str(self.embedding_cache.misses) + ")")
+
+        failures_by_text_hash = {}
+        if len(missed_texts) > 0:
+            missed_embeddings, missed_failures = self.embed_with_provider(list(missed_texts.values()), list(missed_token_counts.values()), chunk_size)
+            # The embeddings that were created are cached even when some texts failed, so a retry only pays for the failed ones
+            created = {text_hash: embedding for text_hash, embedding in zip(missed_texts, missed_embeddings) if embedding is not None}
+            self.embedding_cache.put(created)
+            cached.update(created)
+            missed_text_hashes = list(missed_texts)
+            failures_by_text_hash = {missed_text_hashes[index]: reason for index, reason in missed_failures.items()}
+        return ([cached.get(text_hash) for text_hash in text_hashes],
+                {index: failures_by_text_hash[text_hash] for index, text_hash in enumerate(text_hashes) if text_hash in failures_by_text_hash})
+
+
+    def apply_embedding_transform(self, vector_embeddings):
+        # Transforms the float32 buffers in place, the ones of the texts that could not be embedded are None. Returns the
+        # scales of the int8 quantized embeddings
+        embedding_scales = [None] * len(vector_embeddings)
+        embedded = [index for index, vector_embedding in enumerate(vector_embeddings) if vector_embedding is not None]
+        if len(embedded) == 0:
+            return embedding_scales
+        vectors = numpy.frombuffer(b"".join(vector_embeddings[index] for index in embedded), dtype='<f4').reshape(len(embedded), -1)
+        transformed, scales = transform_embeddings(vectors, self.pca_projection, self.embedding_quantization_value)
+        for row, index in enumerate(embedded):
+            vector_embeddings[index] = transformed[row].tobytes()
+            if scales is not None:
+                embedding_scales[index] = float(scales[row])
+        return embedding_scales
 
     def transform(self, context, flowFile):
         self.logger.info("Inside transform of GetOpenAiVectorEmbedding..")
 
-        # Convert the single json string into List of documents of type Dict
-        chunked_docs_string = flowFile.getContentsAsBytes().decode('utf-8')
-        chunk_docs_json_list_deserialized = json.loads(chunked_docs_string)
+        # Convert the single json string or MessagePack list into List of documents of type Dict
+        contents = flowFile.getContentsAsBytes()
+        input_is_json = is_json_content(contents)
+        if input_is_json:
+            chunk_docs_json_list_deserialized = json.loads(contents.decode('utf-8'))
+        else:
+            chunk_docs_json_list_deserialized = msgpack.unpackb(contents)
 
         self.logger.info("The number of text documents to be embedded are: " + str(len(chunk_docs_json_list_deserialized)))
 
         # Store the text and metadata for each text document in their own lists to pass to OpenAI
         texts = []
+        token_counts = []
         metadatas = []
+        chunk_hashes = []
+        chunk_docs = []
+        seen_chunks = set()
         for doc_dict in chunk_docs_json_list_deserialized:
             #doc_dict = json.loads(doc)
+            if self.chunk_dedupe_store is not None:
+                # Drop the chunks whose vectors were already upserted for the note, or that are repeated in this FlowFile
+                doc_chunk_hash = chunk_hash(self.model_name, doc_dict['page_content'])
+                if (doc_chunk_hash, doc_dict['metadata_source']) in seen_chunks or self.chunk_dedupe_store.contains(doc_chunk_hash, doc_dict['metadata_source']):
+                    continue
+                seen_chunks.add((doc_chunk_hash, doc_dict['metadata_source']))
+                chunk_hashes.append(doc_chunk_hash)
+            chunk_docs.append(doc_dict)
             texts.append(doc_dict['page_content'])
+            # The token count SplitEvernoteText adds when it splits by tokens
+            token_counts.append(doc_dict.get('metadata_token_count'))
             metadata = {"title": doc_dict['metadata_title'],
                         "created": doc_dict['metadata_created'],
                         "updated": doc_dict['metadata_updated'],
                         "tags": doc_dict['metadata_tags'],
-                        "source": doc_dict['metadata_source']
+                        "source": doc_dict['metadata_source'],
+                        # The model the vector was created with, so vectors of different models are not mixed up in an index
+                        "embedding_model": self.model_name
                         }
+            # The notebook, title and id SplitEvernoteText parses out of the exported file name of the note
+            for key in ["notebook", "note_title", "note_id"]:
+                if "metadata_" + key in doc_dict:
+                    metadata[key] = doc_dict["metadata_" + key]
+            # The transform the vector went through after it was embedded, like pca256+int8
+            if self.embedding_transform_name != '':
+                metadata["embedding_transform"] = self.embedding_transform_name
             metadatas.append(metadata)
 
+        if self.chunk_dedupe_store is not None:
+            self.logger.info(str(len(chunk_docs_json_list_deserialized) - len(texts)) + " text documents were already embedded and upserted and are dropped")
+
         # Create an embedding for each text block
         chunk_size = context.getProperty(self.chunk_size.name).asInteger()
-        vector_embeddings = self.openai_embedding_service.embed_documents(texts=texts, chunk_size=chunk_size)
+        vector_embeddings = []
+        failures = {}
+        self.request_batches = 0
+        self.request_tokens = 0
+        throttled_seconds = self.rate_limiter.throttled_seconds
+        if self.embedding_cache is not None:
+            cache_hits, cache_misses = self.embedding_cache.hits, self.embedding_cache.misses
+        if len(texts) > 0:
+            vector_embeddings, failures = self.embed_texts(texts, token_counts, chunk_size)
+
+        # Apply the PCA projection and the int8 quantization when they are set
+        embedding_scales = [None] * len(vector_embeddings)
+        if self.pca_projection is not None or self.embedding_quantization_value == 'int8':
+            embedding_scales = self.apply_embedding_transform(vector_embeddings)
 
         # Now that we have the embeddings, lets create list of json elements with text, metadata and vector embedding
+        output_format = context.getProperty(self.output_format.name).getValue()
         json_list_with_text_embeddings = []
-        for text, vector_embedding, metadata in zip(texts, vector_embeddings, metadatas):
+        failed_chunks = []
+        for index, (text, vector_embedding, metadata) in enumerate(zip(texts, vector_embeddings, metadatas)):
+            if vector_embedding is None:
+                failed_chunks.append(dict(chunk_docs[index], embedding_failure_reason=failures[index]))
+                continue
+            # MessagePack carries the float32 buffers, or the int8 codes, as they are
+            if output_format == 'JSON':
+                vector_embedding = unpack_embedding(vector_embedding) if embedding_scales[index] is None else array('b', vector_embedding).tolist()
             text_embedding_json = {"text": text, "embedding": vector_embedding, "metadata": metadata}
+            if embedding_scales[index] is not None:
+                text_embedding_json["embedding_scale"] = embedding_scales[index]
+            if self.chunk_dedupe_store is not None:
+                text_embedding_json["chunk_hash"] = chunk_hashes[index]
             json_list_with_text_embeddings.append(text_embedding_json)
 
+        attributes = {"embedding.request.count": str(self.request_batches),
+                      "embedding.request.tokens": str(self.request_tokens),
+                      "embedding.throttled.seconds": str(round(self.rate_limiter.throttled_seconds - throttled_seconds, 1))}
+        if self.embedding_cache is not None:
+            # The hits and misses of this FlowFile. The totals since the processor was started are logged
+            attributes["embedding.cache.hits"] = str(self.embedding_cache.hits - cache_hits)
+            attributes["embedding.cache.misses"] = str(self.embedding_cache.misses - cache_misses)
+
+        if len(failed_chunks) > 0:
+            attributes["embedding.failure.count"] = str(len(failed_chunks))
+            attributes["embedding.failure.reason"] = failed_chunks[0]["embedding_failure_reason"]
+            if self.failed_chunk_directory_value is None:
+                self.logger.error(str(len(failed_chunks)) + " text documents could not be embedded, the FlowFile is routed to failure: " + attributes["embedding.failure.reason"])
+                return FlowFileTransformResult(relationship="failure", attributes=attributes)
+            attributes["embedding.failure.file"] = write_failed_chunks(self.failed_chunk_directory_value, failed_chunks, input_is_json)
+            self.logger.error(str(len(failed_chunks)) + " text documents could not be embedded and were written to " + attributes["embedding.failure.file"] +
+                              ": " + attributes["embedding.failure.reason"])
+
+        if output_format == 'MessagePack':
+            attributes["mime.type"] = "application/msgpack"
+            return FlowFileTransformResult(relationship="success", contents=msgpack.packb(json_list_with_text_embeddings), attributes=attributes)
+
         # Convert the list of json strings into a single json string
         json_embedding_string = json.dumps(json_list_with_text_embeddings)
 
-        return FlowFileTransformResult(relationship="success", contents=json_embedding_string)
+        return FlowFileTransformResult(relationship="success", contents=json_embedding_string, attributes=attributes)
 
 
     def getPropertyDescriptors(self):
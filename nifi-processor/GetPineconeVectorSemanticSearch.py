@@ -18,9 +18,9 @@ from nifiapi.properties import PropertyDescriptor
 from nifiapi.properties import StandardValidators
 from nifiapi.properties import ExpressionLanguageScope
 from nifiapi.flowfiletransform import FlowFileTransform, FlowFileTransformResult
+from vector_embedding_utils import create_embedding_service
 
 from langchain.vectorstores import Pinecone
-from langchain.embeddings import OpenAIEmbeddings
 import pinecone
 
 
@@ -28,7 +28,7 @@ class GetPineconeVectorSemanticSearch(FlowFileTransform):
     class Java:
         implements = ['org.apache.nifi.python.processor.FlowFileTransform']
     class ProcessorDetails:
-        dependencies = ['langchain', 'openai', 'pinecone-client','tiktoken']
+        dependencies = ['langchain', 'openai', 'pinecone-client','tiktoken', 'numpy']
         version = '0.0.1-SNAPSHOT'
         description = 'Performs a similarity search in Pinecone based on the query/question that is asked and returns list of similar text docs with metadata.'
         tags = ['Pinecone','OpenAI', 'AI', 'Vector Similarity Search', 'Vector Database']
@@ -38,8 +38,8 @@ class GetPineconeVectorSemanticSearch(FlowFileTransform):
         # Build Property Descriptors
         self.openai_api_key = PropertyDescriptor(
             name="OpenAI API Key",
-            description="The API key to connect to OpeanAI services",
-            required = True,
+            description="The API key to connect to OpeanAI services. Required when the Embedding Provider is OpenAI",
+            required = False,
             sensitive = True
         )
         self.openai_embedding_model = PropertyDescriptor(
@@ -49,6 +49,31 @@ class GetPineconeVectorSemanticSearch(FlowFileTransform):
             default_value = "text-embedding-ada-002",
             allowable_values = ['text-embedding-ada-002', 'text-davinci-001', 'text-curie-001', 'text-babbage-001', 'text-ada-001']
         )
+        self.embedding_provider = PropertyDescriptor(
+            name="Embedding Provider",
+            description="Where the query/question is embedded. Use the same provider and model GetOpenAiVectorEmbedding created the vectors of the index with",
+            default_value = "OpenAI",
+            required = True,
+            allowable_values = ['OpenAI', 'Local Sentence Transformers']
+        )
+        self.local_embedding_model = PropertyDescriptor(
+            name="Local Embedding Model",
+            description="The local path of the sentence-transformers model directory, or the name of a model in the local huggingface cache, used when the Embedding Provider is Local Sentence Transformers",
+            default_value = "sentence-transformers/all-MiniLM-L6-v2",
+            required = False
+        )
+        self.pca_projection_file = PropertyDescriptor(
+            name="PCA Projection File",
+            description="The PCA Projection File GetOpenAiVectorEmbedding projected the vectors of the index with. The query embedding is projected the same way",
+            required = False
+        )
+        self.embedding_quantization = PropertyDescriptor(
+            name="Embedding Quantization",
+            description="The Embedding Quantization GetOpenAiVectorEmbedding quantized the vectors of the index with. The query embedding is quantized the same way",
+            default_value = "None",
+            required = True,
+            allowable_values = ['None', 'int8']
+        )
 
         self.pinecone_api_key = PropertyDescriptor(
             name="Pinecone API Key",
@@ -82,7 +107,7 @@ class GetPineconeVectorSemanticSearch(FlowFileTransform):
             required=True,
         )
 
-        self.descriptors = [self.openai_api_key, self.openai_embedding_model, self.pinecone_api_key, self.pinecone_environment_name, self.pinecone_index_name, self.pinecone_namespace, self.search_results_size]
+        self.descriptors = [self.openai_api_key, self.openai_embedding_model, self.embedding_provider, self.local_embedding_model, self.pca_projection_file, self.embedding_quantization, self.pinecone_api_key, self.pinecone_environment_name, self.pinecone_index_name, self.pinecone_namespace, self.search_results_size]
 
     def onScheduled(self, context):
         self.logger.info("Initializing OpenAI and Pinecone Services.")
@@ -90,7 +115,13 @@ class GetPineconeVectorSemanticSearch(FlowFileTransform):
         # Get the properties from the processor needed to configure the OpenAI Embedding Service
         openai_api_key = context.getProperty(self.openai_api_key.name).getValue()
         model_name = context.getProperty(self.openai_embedding_model.name).getValue()
-        self.openai_embedding_service = OpenAIEmbeddings(openai_api_key=openai_api_key, model=model_name)
+        embedding_provider = context.getProperty(self.embedding_provider.name).getValue()
+        if embedding_provider == 'OpenAI' and (openai_api_key is None or openai_api_key == ''):
+            raise ValueError("The OpenAI API Key is required when the Embedding Provider is OpenAI")
+        self.openai_embedding_service = create_embedding_service(embedding_provider, openai_api_key, model_name,
+                                                                 context.getProperty(self.local_embedding_model.name).getValue(),
+                                                                 context.getProperty(self.pca_projection_file.name).getValue(),
+                                                                 context.getProperty(self.embedding_quantization.name).getValue())
 
         # Initialize Pinecone and get the index we will be upserting into.
         pinecone_api_key =  context.getProperty(self.pinecone_api_key.name).getValue()
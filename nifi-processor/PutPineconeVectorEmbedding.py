@@ -16,21 +16,25 @@
 import json
 import uuid
 
+import msgpack
+
 from nifiapi.properties import PropertyDescriptor
 from nifiapi.properties import StandardValidators
 from nifiapi.properties import ExpressionLanguageScope
 from nifiapi.flowfiletransform import FlowFileTransform, FlowFileTransformResult
+from vector_embedding_utils import ChunkDedupeStore, is_json_content, unpack_embedding
 
 
 import pinecone
 
+
 class PutPineconeVectorEmbedding(FlowFileTransform):
     class Java:
         implements = ['org.apache.nifi.python.processor.FlowFileTransform']
     class ProcessorDetails:
-        dependencies = ['langchain', 'openai', 'pinecone-client','tiktoken']
+        dependencies = ['langchain', 'openai', 'pinecone-client','tiktoken', 'msgpack', 'numpy']
         version = '0.0.1-SNAPSHOT'
-        description = 'Upserts vector text embeddings into Pinecone with the configured index. Expected format is a list of json elements with text, embeddign and metadata'
+        description = 'Upserts vector text embeddings into Pinecone with the configured index. Expected format is a list of json or MessagePack elements with text, embeddign and metadata'
         tags = [ 'Pinecone', 'AI, ''OpenAI',  'Vector Database', 'Embeddings' ]
 
 
@@ -70,7 +74,14 @@ class PutPineconeVectorEmbedding(FlowFileTransform):
             required=True,
         )
 
-        self.descriptors = [self.pinecone_api_key, self.pinecone_environment_name, self.pinecone_index_name, self.pinecone_namespace, self.batch_size]
+        self.chunk_dedupe_store_file = PropertyDescriptor(
+            name="Chunk Dedupe Store File",
+            description="The full path of the sqlite file set as the Chunk Dedupe Store File of GetOpenAiVectorEmbedding. Every chunk is recorded in it once it is upserted so it is not embedded and upserted again",
+            required = False
+        )
+
+        self.descriptors = [self.pinecone_api_key, self.pinecone_environment_name, self.pinecone_index_name, self.pinecone_namespace, self.batch_size, self.chunk_dedupe_store_file]
+        self.chunk_dedupe_store = None
         # self.descriptors = [self.vector_embedding_model_service]
 
     def onScheduled(self, context):
@@ -88,23 +99,39 @@ class PutPineconeVectorEmbedding(FlowFileTransform):
         )
         self.pinecone_index = pinecone.Index(index_name=pinecone_index)
 
+        chunk_dedupe_store_file = context.getProperty(self.chunk_dedupe_store_file.name).getValue()
+        self.chunk_dedupe_store = None
+        if chunk_dedupe_store_file is not None and chunk_dedupe_store_file != '':
+            self.chunk_dedupe_store = ChunkDedupeStore(chunk_dedupe_store_file)
+
+    def onStopped(self, context):
+        if self.chunk_dedupe_store is not None:
+            self.chunk_dedupe_store.close()
+            self.chunk_dedupe_store = None
+
 
 
     def transform(self, context, flowFile):
         self.logger.info("Inside transform of PutPineconeVectorEmbedding..")
 
-        # Convert the json embedding string into list of text embedding documents that contain text, embedding and metadata for each text chunk
-        chunked_docs_string = flowFile.getContentsAsBytes().decode('utf-8')
-        chunk_docs_json_list_deserialized = json.loads(chunked_docs_string)
+        # Convert the json embedding string or MessagePack list into list of text embedding documents that contain text, embedding and metadata for each text chunk
+        contents = flowFile.getContentsAsBytes()
+        if is_json_content(contents):
+            chunk_docs_json_list_deserialized = json.loads(contents.decode('utf-8'))
+        else:
+            chunk_docs_json_list_deserialized = msgpack.unpackb(contents)
 
         # Store the text, embedding and metadata in seperate lists which we will use to batch up and insert into pinecone
         texts = []
         embeddings = []
         metadatas = []
+        chunk_hashes_and_sources = []
         for doc_dict in chunk_docs_json_list_deserialized:
             texts.append(doc_dict["text"])
-            embeddings.append(doc_dict['embedding'])
+            embeddings.append((doc_dict['embedding'], doc_dict.get('embedding_scale')))
             metadatas.append(doc_dict['metadata'])
+            if "chunk_hash" in doc_dict:
+                chunk_hashes_and_sources.append((doc_dict["chunk_hash"], doc_dict['metadata']['source']))
 
 
         batch_size = context.getProperty(self.batch_size.name).asInteger()
@@ -120,8 +147,8 @@ class PutPineconeVectorEmbedding(FlowFileTransform):
             # create ids
             ids_batch = [str(uuid.uuid4()) for n in range(i, i_end)]
             vector_ids.extend(ids_batch)
-            # get batch of embeddings
-            embeddings_batch = embeddings[i:i_end]
+            # get batch of embeddings. Float32 buffers are only turned into the list of floats Pinecone takes here
+            embeddings_batch = [unpack_embedding(embedding, scale) for embedding, scale in embeddings[i:i_end]]
             # prep metadata and upsert batch
             metadata_batch = metadatas[i:i_end]
 
@@ -132,6 +159,10 @@ class PutPineconeVectorEmbedding(FlowFileTransform):
             # upsert to Pinecone
             self.pinecone_index.upsert(vectors=list(to_upsert), namespace=namespace)
 
+        # Only record the chunks once all of them are upserted
+        if self.chunk_dedupe_store is not None and len(chunk_hashes_and_sources) > 0:
+            self.chunk_dedupe_store.record(chunk_hashes_and_sources)
+
         # Return a list of Ids for each embedding inserted
         vector_ids_json_string = json.dumps(vector_ids)
         self.logger.info(str(len(vector_ids)) + " vectors were inserted wtih the following ids: " + vector_ids_json_string)
@@ -12,9 +12,22 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import datetime
+import calendar
+import functools
+import gzip
+import io
 import json
+import multiprocessing
+import os
+import re
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import msgpack
+import tiktoken
+import zstandard
+from lxml import etree
 
 from nifiapi.properties import PropertyDescriptor
 from nifiapi.properties import StandardValidators
@@ -22,13 +35,194 @@ from nifiapi.properties import ExpressionLanguageScope
 from nifiapi.flowfiletransform import FlowFileTransform, FlowFileTransformResult
 
 from langchain.document_loaders import EverNoteLoader
+from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+
+@functools.lru_cache(maxsize=None)
+def get_tiktoken_encoding(encoding_name):
+    # Loading an encoding reads its BPE ranks, so it is only done once per python worker
+    return tiktoken.get_encoding(encoding_name)
+
+
+# Markers of the line breaks, paragraph breaks and list indentation while an ENML body is converted to text
+LINE_BREAK = "\x00"
+BLOCK_BREAK = "\x01"
+LIST_INDENT = "\x02"
+PREFORMATTED_SPACE = "\x03"
+BLOCK_TAGS = {"div", "p", "blockquote", "pre", "table", "h1", "h2", "h3", "h4", "h5", "h6", "en-note", "center", "dl"}
+SKIPPED_TAGS = {"head", "style", "script", "en-crypt"}
+BLOCK_BREAK_PATTERN = re.compile(r"\x00*\x01[\x00\x01]*")
+
+# The name ExportNotesFromEvernote gives the file of a note, parsed the same way the chat UI parses the sources
+EXPORT_FILE_NAME_PATTERN = re.compile(r"Notebook__(.*?)__Note__(.*?)__Id__(.*?)\.enex")
+
+# The notes are sent to the process pool in batches of up to this many notes or bytes of ENML
+NOTES_PER_SPLIT_TASK = 64
+BYTES_PER_SPLIT_TASK = 4 * 1024 * 1024
+
+
+def convert_enml_element(elem, parts, list_stack, preformatted):
+    tag = elem.tag if isinstance(elem.tag, str) else None
+    if tag in SKIPPED_TAGS:
+        return
+
+    if tag in BLOCK_TAGS:
+        parts.append(BLOCK_BREAK)
+        if tag[0] == "h" and tag[1:].isdigit():
+            parts.append("#" * int(tag[1:]) + " ")
+    elif tag in ("ul", "ol"):
+        parts.append(LINE_BREAK if len(list_stack) > 0 else BLOCK_BREAK)
+        list_stack.append([tag, 0])
+    elif tag == "li":
+        # List items keep the html2text markdown so the chunk boundaries fall in the same places
+        marker = "* "
+        if len(list_stack) > 0 and list_stack[-1][0] == "ol":
+            list_stack[-1][1] += 1
+            marker = str(list_stack[-1][1]) + ". "
+        # A nested list already started on a new line, and the lists that just ended inside the previous item did too
+        while len(parts) > 0 and (parts[-1].isspace() or parts[-1] == LINE_BREAK):
+            parts.pop()
+        # Like html2text a nested list is indented two spaces more than its parent list, three when the parent is an ordered list
+        indent = LIST_INDENT + "".join(LIST_INDENT + (PREFORMATTED_SPACE if parent[0] == "ol" else "") for parent in list_stack[:-1])
+        parts.append(LINE_BREAK + indent + marker)
+    elif tag in ("br", "tr", "dt", "dd"):
+        parts.append(LINE_BREAK)
+    elif tag in ("td", "th") and elem.getprevious() is not None:
+        parts.append(" | ")
+    elif tag == "hr":
+        parts.append(BLOCK_BREAK + "* * *" + BLOCK_BREAK)
+    elif tag == "en-todo":
+        parts.append("[x] " if elem.get("checked") == "true" else "[ ] ")
+
+    preformatted = preformatted or tag == "pre"
+    if elem.text:
+        parts.append(convert_preformatted_text(elem.text) if preformatted else elem.text)
+    for child in elem:
+        convert_enml_element(child, parts, list_stack, preformatted)
+
+    if tag in BLOCK_TAGS:
+        parts.append(BLOCK_BREAK)
+    elif tag in ("ul", "ol"):
+        list_stack.pop()
+        parts.append(LINE_BREAK if len(list_stack) > 0 else BLOCK_BREAK)
+
+    if elem.tail:
+        parts.append(convert_preformatted_text(elem.tail) if preformatted else elem.tail)
+
+
+def convert_preformatted_text(text):
+    # The whitespace of preformatted text is kept out of the whitespace collapsing of the whole text
+    return text.replace("\r", "").replace("\t", "    ").replace(" ", PREFORMATTED_SPACE).replace("\n", LINE_BREAK)
+
+
+def convert_enml_to_text(content):
+    # Converts an ENML note body to text with lxml's html parser. Paragraphs, headings, lists and checkboxes are kept in the
+    # markdown like form html2text gives them, while links and emphasis are reduced to their text
+    if content is None:
+        return None
+    start = content.find("<en-note")
+    root = etree.fromstring(content[start:] if start >= 0 else content, etree.HTMLParser(remove_comments=True, huge_tree=True))
+    if root is None:
+        return ""
+
+    parts = []
+    convert_enml_element(root, parts, [], False)
+    # The break markers are not whitespace, so only the whitespace of the html text is collapsed
+    text = " ".join("".join(parts).split())
+    for marker in (LINE_BREAK, BLOCK_BREAK):
+        text = text.replace(" " + marker, marker).replace(marker + " ", marker)
+    text = BLOCK_BREAK_PATTERN.sub("\n\n", text)
+    return text.replace(LINE_BREAK, "\n").replace(LIST_INDENT, "  ").replace(PREFORMATTED_SPACE, " ").strip()
+
+
+def parse_enex_note(note, prefix=None):
+    # The same note dict the langchain EverNoteLoader builds, without the decoded resources that are never used. The content is
+    # kept as ENML and only converted to text when the note is split, which can happen in a worker process
+    note_dict = {}
+    for elem in note:
+        if elem.tag == "resource":
+            continue
+        elif elem.tag == "created" or elem.tag == "updated":
+            note_dict[elem.tag] = time.strptime(elem.text, "%Y%m%dT%H%M%SZ")
+        elif elem.tag == "note-attributes":
+            note_dict.update(parse_enex_note(elem, elem.tag))
+        else:
+            note_dict[elem.tag] = elem.text
+    if prefix is None:
+        return note_dict
+    return {f"{prefix}.{key}": value for key, value in note_dict.items()}
+
+
+def iterparse_enex_notes(stream):
+    # Yield the notes of an enex document one at a time. Every note element is freed once it has been parsed, so the memory
+    # stays bounded by the largest note instead of the size of the document. Resources are freed as soon as they are read
+    context = etree.iterparse(stream, events=("end",), tag=("note", "resource"), encoding="utf-8", strip_cdata=False, huge_tree=True, recover=True)
+    for action, elem in context:
+        if elem.tag == "note":
+            yield parse_enex_note(elem)
+        elem.clear(keep_tail=False)
+        if elem.tag == "note":
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    del context
+
+
+@functools.lru_cache(maxsize=None)
+def get_text_splitter(chunk_size, chunk_overlap, tokenizer_encoding):
+    # Chunks are measured in tokens of the tokenizer encoding, or in characters when there is none
+    if tokenizer_encoding is None:
+        return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    encoding = get_tiktoken_encoding(tokenizer_encoding)
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                          length_function=lambda text: len(encoding.encode(text, disallowed_special=())))
+
+
+def normalize_note_metadata(metadata):
+    # Runs once per note and every chunk of the note gets a copy of the result.
+    # The enex dates are UTC and become epoch seconds so they can be range filtered in a vector db
+    for key in ['created', 'updated']:
+        if isinstance(metadata.get(key), time.struct_time):
+            metadata[key] = calendar.timegm(metadata[key])
+
+    # The notebook, title and guid suffix of the note are parsed from the name of its exported file
+    match = EXPORT_FILE_NAME_PATTERN.search(os.path.basename(metadata.get("source") or ""))
+    if match is not None:
+        metadata["notebook"], metadata["note_title"], metadata["note_id"] = match.groups()
+    return metadata
+
+
+def split_notes(notes, split_settings):
+    # Converts and splits a list of (ENML content, metadata) notes. This runs in the processor or in a worker process of the
+    # process pool, so everything it needs comes in its arguments and the splitter and the encoding are cached per process
+    enml_converter, chunk_size, chunk_overlap, tokenizer_encoding, output_format = split_settings
+    convert_content = convert_enml_to_text if enml_converter == 'lxml' else EverNoteLoader._parse_content
+    text_splitter = get_text_splitter(chunk_size, chunk_overlap, tokenizer_encoding)
+    encoding = get_tiktoken_encoding(tokenizer_encoding) if tokenizer_encoding is not None else None
+
+    # Split one note at a time so only the chunks of the note are held besides the chunks emitted so far
+    chunk_docs = []
+    for content, metadata in notes:
+        metadata = normalize_note_metadata(metadata)
+        for chunk in text_splitter.split_documents([Document(page_content=convert_content(content), metadata=metadata)]):
+            if encoding is not None:
+                # Downstream batching can use the token count of the chunk without tokenizing it again
+                chunk.metadata['token_count'] = len(encoding.encode(chunk.page_content, disallowed_special=()))
+            if output_format == 'MessagePack':
+                # The same flattened record the ingestion flow builds out of the json with its Jolt transform
+                record = {"page_content": chunk.page_content}
+                record.update({"metadata_" + key: value for key, value in chunk.metadata.items()})
+                chunk_docs.append(record)
+            else:
+                chunk_docs.append(chunk.json())
+    return chunk_docs
+
+
 class SplitEvernoteText(FlowFileTransform):
     class Java:
         implements = ['org.apache.nifi.python.processor.FlowFileTransform']
     class ProcessorDetails:
-        dependencies = ['langchain', 'lxml', 'html2text']
+        dependencies = ['langchain', 'lxml', 'html2text', 'zstandard', 'msgpack', 'tiktoken']
         version = '0.0.1-SNAPSHOT'
         description = 'Converts a Evernote enex file into text documents that are split/chunked using Langchain text splitting utilities. The text are split to be optimized to create vector text embeddings'
         tags = ['text splitting', 'AI',  'evernote', "enex" 'langchain']
@@ -38,61 +232,153 @@ class SplitEvernoteText(FlowFileTransform):
         # Build Property Descriptors
         self.pdf_doc_url = PropertyDescriptor(
             name="PDF Document File",
-            description="The full path to the PDF doc Url",
-            required = True,
+            description="The full path to the enex file to split. The file can hold one or many notes and can be gzip or zstd compressed. If not set, the enex document is read from the FlowFile content",
+            required = False,
             expression_language_scope=ExpressionLanguageScope.FLOWFILE_ATTRIBUTES
         )
         self.chunk_size = PropertyDescriptor(
             name="Chunk Size",
-            description="The number of characters that each text chunk should be",
+            description="The number of characters or tokens, depending on the Chunk Size Unit, that each text chunk should be",
             default_value = 1000,
             required = True,
         )
         self.chunk_overlap = PropertyDescriptor(
             name="Chunk Overlap",
-            description="The number of characters to overlap between two contiguous text chunks",
+            description="The number of characters or tokens, depending on the Chunk Size Unit, to overlap between two contiguous text chunks",
             default_value = 100,
             required = True,
         )
-        self.descriptors = [self.pdf_doc_url, self.chunk_size, self.chunk_overlap]
+        self.chunk_size_unit = PropertyDescriptor(
+            name="Chunk Size Unit",
+            description="Whether the Chunk Size and Chunk Overlap are counted in characters or in tokens of the Tokenizer Encoding. When counted in tokens, the token count of every chunk is added to its metadata as token_count",
+            default_value = "Characters",
+            required = True,
+            allowable_values = ['Characters', 'Tokens']
+        )
+        self.tokenizer_encoding = PropertyDescriptor(
+            name="Tokenizer Encoding",
+            description="The tiktoken encoding used to count tokens. cl100k_base is the encoding of the text-embedding-ada-002 model",
+            default_value = "cl100k_base",
+            required = True,
+            allowable_values = ['cl100k_base', 'p50k_base', 'r50k_base']
+        )
+        self.output_format = PropertyDescriptor(
+            name="Output Format",
+            description="The format of the chunks written to the FlowFile content. JSON is a list of the json of every chunk. MessagePack is a list of records with the page_content and flattened metadata_* fields that GetOpenAiVectorEmbedding reads directly",
+            default_value = "JSON",
+            required = True,
+            allowable_values = ['JSON', 'MessagePack']
+        )
+        self.enml_converter = PropertyDescriptor(
+            name="ENML Converter",
+            description="How the ENML body of a note is converted to text. html2text is the pure python converter of the langchain EverNoteLoader. lxml is a much faster converter on lxml's C parser that keeps the paragraph, heading, list and checkbox structure but reduces links to their text",
+            default_value = "html2text",
+            required = True,
+            allowable_values = ['html2text', 'lxml']
+        )
+        self.split_parallelism = PropertyDescriptor(
+            name="Split Parallelism",
+            description="The number of worker processes the notes of a multi-note enex document are converted and split in. 1 splits the notes in the processor itself. 0 starts a worker process for every available core. The chunks are always emitted in the order of the notes",
+            default_value = "1",
+            required = True,
+            validators=[StandardValidators.NON_NEGATIVE_INTEGER_VALIDATOR]
+        )
+        self.descriptors = [self.pdf_doc_url, self.chunk_size, self.chunk_overlap, self.chunk_size_unit, self.tokenizer_encoding, self.output_format, self.enml_converter, self.split_parallelism]
+        self.process_pool = None
 
-    def transform(self, context, flowFile):
+    def onScheduled(self, context):
+        self.split_parallelism_value = context.getProperty(self.split_parallelism.name).asInteger()
+        if self.split_parallelism_value == 0:
+            self.split_parallelism_value = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
 
-        doc_url = context.getProperty(self.pdf_doc_url.name).evaluateAttributeExpressions(flowFile).getValue()
+        # The workers are spawned rather than forked since the processor runs in a multi-threaded python process
+        self.process_pool = None
+        if self.split_parallelism_value > 1:
+            self.logger.info("Starting a process pool of " + str(self.split_parallelism_value) + " workers to split the notes")
+            self.process_pool = ProcessPoolExecutor(max_workers=self.split_parallelism_value, mp_context=multiprocessing.get_context("spawn"))
 
-        self.logger.info("Inside transform of Chunking method for Evernote docs ")
-        loader = EverNoteLoader(doc_url, load_single_document=False)
-        doc = loader.load()
+    def onStopped(self, context):
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=True, cancel_futures=True)
+            self.process_pool = None
 
-        chunk_size = context.getProperty(self.chunk_size).asInteger()
-        chunk_overlap = context.getProperty(self.chunk_overlap).asInteger()
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        chunked_docs = text_splitter.split_documents(doc)
-        number_of_chunks = len(chunked_docs)
+    def open_enex_stream(self, stream):
+        # Batched exports can be gzip or zstd compressed. The compression is detected from the magic bytes of the content
+        stream = io.BufferedReader(stream)
+        magic = stream.peek(4)[:4]
+        if magic[:2] == b'\x1f\x8b':
+            return gzip.GzipFile(fileobj=stream)
+        if magic == b'\x28\xb5\x2f\xfd':
+            return zstandard.ZstdDecompressor().stream_reader(stream)
+        return stream
 
-        self.logger.info("PDF Doc["+doc_url+"] was chunked into ["+str(number_of_chunks)+"] docs")
+    def load_enex_notes(self, stream, source_directory, default_source):
+        # Notes of batched and FlowFile content exports carry the name of the file they would have been exported to on their own.
+        # That name is used as their source so the chat UI can still show the notebook and note of every source.
+        # Notes exported one per file have no export file name, the enex file itself is their source
+        for note in iterparse_enex_notes(self.open_enex_stream(stream)):
+            if note.get("content") is None:
+                continue
+            metadata = {key: value for key, value in note.items() if key not in ["content", "export-file-name"]}
+            metadata["source"] = default_source
+            if note.get("export-file-name") is not None:
+                metadata["source"] = note["export-file-name"] if source_directory is None else os.path.join(source_directory, note["export-file-name"])
+            yield note["content"], metadata
+
+    def split_notes_in_process_pool(self, notes, split_settings):
+        # Fan batches of notes out to the process pool. Only a few batches per worker are in flight, so the notes are still
+        # streamed out of the enex document, and the chunks are collected in the order the batches were submitted
+        chunk_docs = []
+        pending_batches = deque()
+        batch = []
+        batch_size = 0
+        for note in notes:
+            batch.append(note)
+            batch_size += len(note[0])
+            if len(batch) >= NOTES_PER_SPLIT_TASK or batch_size >= BYTES_PER_SPLIT_TASK:
+                pending_batches.append(self.process_pool.submit(split_notes, batch, split_settings))
+                batch = []
+                batch_size = 0
+                if len(pending_batches) >= 2 * self.split_parallelism_value:
+                    chunk_docs.extend(pending_batches.popleft().result())
+        if len(batch) > 0:
+            pending_batches.append(self.process_pool.submit(split_notes, batch, split_settings))
+        while len(pending_batches) > 0:
+            chunk_docs.extend(pending_batches.popleft().result())
+        return chunk_docs
 
-        # Convert he list of Langhcain Document into List of Json strings.
-        # Also format the created/updated metadata to date ints so we can do metadata filtering in a vector db
-        chunk_docs_json = []
-        for doc in chunked_docs:
+    def split_enex_notes(self, notes, split_settings):
+        if self.process_pool is None:
+            return split_notes(notes, split_settings)
+        return self.split_notes_in_process_pool(notes, split_settings)
 
-            # Assuming doc.metadata['created'] is a time.struct_time object. Convert to string
-            created_str =  time.strftime("%Y%m%dT%H%M%SZ", doc.metadata['created'])
-            updated_str = time.strftime("%Y%m%dT%H%M%SZ", doc.metadata['updated'])
+    def transform(self, context, flowFile):
 
-            # Parse the date string to a datetime object
-            create_dt = datetime.datetime.strptime( created_str, "%Y%m%dT%H%M%SZ")
-            update_dt = datetime.datetime.strptime(updated_str , "%Y%m%dT%H%M%SZ")
+        doc_url = context.getProperty(self.pdf_doc_url.name).evaluateAttributeExpressions(flowFile).getValue()
 
-            # Convert the datetime object to a Unix timestamp with only the date component
-            # This is done so we can store this is a metadata time column in a vector db
+        chunk_size = context.getProperty(self.chunk_size).asInteger()
+        chunk_overlap = context.getProperty(self.chunk_overlap).asInteger()
+        tokenizer_encoding = None
+        if context.getProperty(self.chunk_size_unit.name).getValue() == 'Tokens':
+            tokenizer_encoding = context.getProperty(self.tokenizer_encoding.name).getValue()
+        output_format = context.getProperty(self.output_format.name).getValue()
+        split_settings = (context.getProperty(self.enml_converter.name).getValue(), chunk_size, chunk_overlap, tokenizer_encoding, output_format)
 
-            doc.metadata['created'] = int(create_dt.timestamp())
-            doc.metadata['updated'] = int(update_dt.timestamp())
+        # The notes are streamed out of the enex document and split as they are read
+        self.logger.info("Inside transform of Chunking method for Evernote docs ")
+        if doc_url is None or doc_url == '':
+            doc_url = "FlowFile content"
+            # A note without an export file name gets the name of the FlowFile as its source, like the enex file of a note exported on its own
+            chunk_docs_json = self.split_enex_notes(self.load_enex_notes(io.BytesIO(flowFile.getContentsAsBytes()), None, flowFile.getAttribute("filename")), split_settings)
+        else:
+            with open(doc_url, "rb") as file:
+                chunk_docs_json = self.split_enex_notes(self.load_enex_notes(file, os.path.dirname(doc_url), doc_url), split_settings)
+        number_of_chunks = len(chunk_docs_json)
+
+        self.logger.info("PDF Doc["+doc_url+"] was chunked into ["+str(number_of_chunks)+"] docs")
 
-            doc_json = doc.json()
-            chunk_docs_json.append(doc_json)
+        if output_format == 'MessagePack':
+            return FlowFileTransformResult(relationship="success", contents=msgpack.packb(chunk_docs_json), attributes={"mime.type": "application/msgpack"})
 
         # Convert the List of json strings into a single json string that can be return in the Flow File Result
         single_json_doc = json.dumps(chunk_docs_json)
@@ -0,0 +1,130 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Helpers shared by the processors that create, upsert and query the vector embeddings. NiFi puts this directory on the
+# path of the processors, so they import it like any other module.
+
+import sqlite3
+import sys
+from array import array
+
+import numpy
+
+try:
+    from langchain.embeddings.base import Embeddings
+except ImportError:
+    # Only the processors that query a langchain vector store need langchain. GetOpenAiVectorEmbedding does not install it
+    Embeddings = object
+
+
+def is_json_content(contents):
+    # Json content is a list or an object. A MessagePack list or map never starts with '[' or '{'. Only the head is
+    # stripped, stripping the whole content would copy it
+    return contents[:64].lstrip()[:1] in [b'[', b'{']
+
+
+def unpack_embedding(embedding, scale=None):
+    # Embeddings are little-endian float32 buffers, the way OpenAI sends them base64 encoded. They are only turned into
+    # a list of floats when they are written as json or upserted to Pinecone
+    if scale is not None:
+        # int8 quantized embeddings are codes, a byte buffer or a list of ints, that are scaled back to floats
+        return [code * scale for code in (array('b', embedding) if isinstance(embedding, bytes) else embedding)]
+    if not isinstance(embedding, bytes):
+        return embedding
+    buffer = array('f')
+    buffer.frombytes(embedding)
+    if sys.byteorder == 'big':
+        buffer.byteswap()
+    return buffer.tolist()
+
+
+class ChunkDedupeStore:
+    # Local sqlite store of the chunks whose vectors were upserted, keyed by the hash of the normalized chunk text and the
+    # embedding model along with the source note of the chunk. PutPineconeVectorEmbedding records the chunks once they are
+    # upserted and GetOpenAiVectorEmbedding drops the chunks it holds before they are embedded.
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS upserted_chunk (chunk_hash TEXT NOT NULL, source TEXT NOT NULL, PRIMARY KEY (chunk_hash, source))")
+        self.connection.commit()
+
+    def contains(self, chunk_hash, source):
+        return self.connection.execute("SELECT 1 FROM upserted_chunk WHERE chunk_hash = ? AND source = ?", (chunk_hash, source)).fetchone() is not None
+
+    def record(self, chunk_hashes_and_sources):
+        self.connection.executemany("INSERT OR IGNORE INTO upserted_chunk (chunk_hash, source) VALUES (?, ?)", chunk_hashes_and_sources)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def load_pca_projection(path):
+    # The mean and the principal components fitted on the embeddings of the corpus with testing/embedding-compression-benchmark.py
+    with numpy.load(path) as pca_projection:
+        return pca_projection["mean"].astype(numpy.float32), pca_projection["components"].astype(numpy.float32)
+
+
+def transform_embeddings(vectors, pca_projection, quantization):
+    # Projects the (n, dimensions) float32 vectors onto the principal components and normalizes them again, and/or quantizes
+    # them to int8 codes with a scale per vector. Returns the vectors along with the scales, None when they are not quantized
+    if pca_projection is not None:
+        mean, components = pca_projection
+        vectors = (vectors - mean) @ components.T
+        norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / numpy.where(norms > 0, norms, 1)
+    if quantization != 'int8':
+        return vectors.astype('<f4'), None
+    scales = numpy.abs(vectors).max(axis=1) / 127
+    scales = numpy.where(scales > 0, scales, 1)
+    return numpy.rint(vectors / scales[:, None]).astype(numpy.int8), scales
+
+
+class TransformedEmbeddings(Embeddings):
+    # Applies the PCA projection and the int8 quantization GetOpenAiVectorEmbedding applied to the vectors of the index to
+    # the query embeddings. The int8 codes are scaled back to floats like PutPineconeVectorEmbedding does
+
+    def __init__(self, embeddings, pca_projection, quantization):
+        self.embeddings = embeddings
+        self.pca_projection = pca_projection
+        self.quantization = quantization
+
+    def transform(self, vectors):
+        transformed, scales = transform_embeddings(numpy.array(vectors, dtype=numpy.float32), self.pca_projection, self.quantization)
+        if scales is not None:
+            transformed = transformed * scales[:, None]
+        return transformed.astype(numpy.float32).tolist()
+
+    def embed_documents(self, texts):
+        return self.transform(self.embeddings.embed_documents(texts))
+
+    def embed_query(self, text):
+        return self.transform([self.embeddings.embed_query(text)])[0]
+
+
+def create_embedding_service(embedding_provider, openai_api_key, openai_model_name, local_model_name, pca_projection_file, quantization):
+    # The query is embedded with the same model as the notes. The local sentence-transformers model runs on the CPU and is
+    # normalized like GetOpenAiVectorEmbedding normalizes it, sentence-transformers has to be installed to use it
+    from langchain.embeddings import HuggingFaceEmbeddings, OpenAIEmbeddings
+
+    if embedding_provider == 'Local Sentence Transformers':
+        embedding_service = HuggingFaceEmbeddings(model_name=local_model_name, model_kwargs={"device": "cpu"}, encode_kwargs={"normalize_embeddings": True})
+    else:
+        embedding_service = OpenAIEmbeddings(openai_api_key=openai_api_key, model=openai_model_name)
+    if (pca_projection_file is None or pca_projection_file == '') and quantization != 'int8':
+        return embedding_service
+    pca_projection = load_pca_projection(pca_projection_file) if pca_projection_file is not None and pca_projection_file != '' else None
+    return TransformedEmbeddings(embedding_service, pca_projection, quantization)
@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import msgpack
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from processor_harness import load_processor_module
+
+# Recall@k against memory of the PCA projection and int8 quantization of GetOpenAiVectorEmbedding on our own corpus.
+# The corpus is read from an Embedding Cache File or from FlowFile contents written by GetOpenAiVectorEmbedding, a share of
+# the embeddings is held out as the queries and the top k of every transform is compared with the exact top k of the full
+# float vectors. With --save-projection the PCA projection is fitted on the whole corpus and saved as the PCA Projection File
+# of the processors. Pinecone stores float vectors, so int8 only saves memory where the codes are kept as they are, like the
+# FlowFile content, while the PCA projection shrinks the Pinecone index itself.
+# Run it with the NiFi python api ($NIFI_HOME/python/api) and the processor dependencies on the PYTHONPATH, e.g:
+#   python embedding-compression-benchmark.py --embedding-cache /data/embedding-cache.db --dimensions 128 256 512
+#   python embedding-compression-benchmark.py --embedding-cache /data/embedding-cache.db --save-projection 256 /data/pca256.npz
+
+embedding_module = load_processor_module('GetOpenAiVectorEmbedding')
+
+
+def read_embedding_cache(path):
+    connection = sqlite3.connect(path)
+    buffers = [row[0] for row in connection.execute("SELECT embedding FROM embedding")]
+    connection.close()
+    return numpy.frombuffer(b"".join(buffers), dtype='<f4').reshape(len(buffers), -1)
+
+
+def read_embedding_files(paths):
+    vectors = []
+    for path in paths:
+        with open(path, "rb") as file:
+            contents = file.read()
+        docs = json.loads(contents.decode("utf-8")) if embedding_module.is_json_content(contents) else msgpack.unpackb(contents)
+        for doc in docs:
+            if "embedding_scale" in doc:
+                raise ValueError(path + " holds int8 quantized embeddings, the benchmark needs the float embeddings")
+            embedding = doc["embedding"]
+            vectors.append(embedding_module.unpack_embedding(embedding) if isinstance(embedding, bytes) else embedding)
+    return numpy.array(vectors, dtype=numpy.float32)
+
+
+def synthetic_embeddings(number_of_vectors, dimensions, seed=42):
+    # Unit vectors around a few hundred topics in a low dimensional subspace, roughly how text embeddings are spread
+    synthetic_random = numpy.random.default_rng(seed)
+    basis = synthetic_random.standard_normal((96, dimensions)).astype(numpy.float32)
+    topics = synthetic_random.standard_normal((300, 96)).astype(numpy.float32)
+    latent = topics[synthetic_random.integers(0, len(topics), number_of_vectors)] + 0.6 * synthetic_random.standard_normal((number_of_vectors, 96)).astype(numpy.float32)
+    vectors = latent @ basis + 0.5 * synthetic_random.standard_normal((number_of_vectors, dimensions)).astype(numpy.float32)
+    return vectors / numpy.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def fit_pca_projection(vectors, dimensions):
+    # The principal components are the eigenvectors of the covariance matrix with the largest eigenvalues. The covariance
+    # matrix is only dimensions x dimensions however large the corpus is
+    mean = vectors.mean(axis=0, dtype=numpy.float64)
+    centered = vectors - mean.astype(numpy.float32)
+    eigenvalues, eigenvectors = numpy.linalg.eigh((centered.T @ centered).astype(numpy.float64))
+    components = eigenvectors[:, numpy.argsort(eigenvalues)[::-1][:dimensions]].T
+    return mean.astype(numpy.float32), components.astype(numpy.float32)
+
+
+def transformed_vectors(vectors, pca_projection, quantization):
+    # The vectors as Pinecone holds them, the int8 codes are scaled back to floats like PutPineconeVectorEmbedding does
+    transformed, scales = embedding_module.transform_embeddings(vectors, pca_projection, quantization)
+    if scales is not None:
+        return transformed.astype(numpy.float32) * scales[:, None].astype(numpy.float32)
+    return transformed
+
+
+def top_k(queries, vectors, k):
+    scores = queries @ vectors.T
+    nearest = numpy.argpartition(-scores, k, axis=1)[:, :k]
+    return [set(row) for row in nearest]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k against memory of the PCA projection and int8 quantization of the embeddings")
+    parser.add_argument("--embedding-cache", help="An Embedding Cache File of GetOpenAiVectorEmbedding to read the corpus from")
+    parser.add_argument("--embedding-files", nargs="+", help="FlowFile contents written by GetOpenAiVectorEmbedding to read the corpus from")
+    parser.add_argument("--synthetic", type=int, default=20000, help="The number of synthetic embeddings when no corpus is given")
+    parser.add_argument("--queries", type=int, default=500, help="The number of embeddings held out as the queries")
+    parser.add_argument("--k", type=int, default=10, help="The number of nearest neighbours the recall is measured at")
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[64, 128, 256, 512], help="The PCA dimensions to measure")
+    parser.add_argument("--save-projection", nargs=2, metavar=("DIMENSIONS", "PATH"), help="Fit the PCA projection on the whole corpus and save it")
+    args = parser.parse_args()
+
+    if args.embedding_cache is not None:
+        vectors = read_embedding_cache(args.embedding_cache)
+    elif args.embedding_files is not None:
+        vectors = read_embedding_files(args.embedding_files)
+    else:
+        vectors = synthetic_embeddings(args.synthetic, 1536)
+    print(f"Corpus of {len(vectors)} embeddings of {vectors.shape[1]} dimensions")
+
+    if args.save_projection is not None:
+        mean, components = fit_pca_projection(vectors, int(args.save_projection[0]))
+        numpy.savez(args.save_projection[1], mean=mean, components=components)
+        print(f"Saved the PCA projection to {components.shape[0]} dimensions to {args.save_projection[1]}")
+        return
+
+    # The queries are held out of the index and of the PCA fit
+    order = numpy.random.default_rng(7).permutation(len(vectors))
+    queries = vectors[order[:args.queries]]
+    documents = vectors[order[args.queries:]]
+    exact = top_k(queries, documents, args.k)
+
+    start = time.perf_counter()
+    mean, components = fit_pca_projection(documents, max(args.dimensions))
+    print(f"Fitted the PCA projection in {time.perf_counter() - start:.1f} seconds")
+
+    full_megabytes = len(documents) * vectors.shape[1] * 4 / 1_000_000
+    print(f"{'dimensions':>10} {'quantization':>12} {'bytes/vector':>12} {'MB':>9} {'memory':>7} {'recall@' + str(args.k):>10}")
+    for dimensions in [None] + sorted(args.dimensions, reverse=True):
+        pca_projection = None if dimensions is None else (mean, components[:dimensions])
+        for quantization in ['None', 'int8']:
+            approximate = top_k(transformed_vectors(queries, pca_projection, quantization),
+                                transformed_vectors(documents, pca_projection, quantization), args.k)
+            recall = numpy.mean([len(a & e) / args.k for a, e in zip(approximate, exact)])
+            stored_dimensions = vectors.shape[1] if dimensions is None else dimensions
+            # An int8 vector is a byte per dimension along with its float32 scale
+            bytes_per_vector = stored_dimensions * 4 if quantization == 'None' else stored_dimensions + 4
+            megabytes = len(documents) * bytes_per_vector / 1_000_000
+            print(f"{stored_dimensions:>10} {quantization:>12} {bytes_per_vector:>12} {megabytes:>9.1f} {megabytes / full_megabytes:>7.1%} {recall:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
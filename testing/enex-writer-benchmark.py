@@ -0,0 +1,91 @@
+import importlib.util
+import os
+import random
+import string
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from xml.dom import minidom
+
+# Micro benchmark of the streaming enex writer used by ExportNotesFromEvernote against the ElementTree -> minidom
+# pretty print round trip it replaced.
+# Run it with the NiFi python api ($NIFI_HOME/python/api) and the processor dependencies on the PYTHONPATH.
+
+processor_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nifi-processor', 'ExportNotesFromEvernote.py')
+spec = importlib.util.spec_from_file_location('ExportNotesFromEvernote', processor_path)
+export_module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(export_module)
+
+
+def synthetic_enml(size_in_bytes):
+    # Build an ENML body of roughly the requested size out of paragraphs, lists and characters that need escaping
+    random.seed(size_in_bytes)
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="no"?>',
+             '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">', '<en-note>']
+    length = 0
+    while length < size_in_bytes:
+        words = ' '.join(''.join(random.choices(string.ascii_lowercase, k=random.randint(2, 10))) for _ in range(60))
+        part = f'<div>{words} &amp; &lt;escaped&gt; "quotes"</div><ul><li>{words[:80]}</li><li>]]&gt; done</li></ul>'
+        parts.append(part)
+        length += len(part)
+    parts.append('</en-note>')
+    return ''.join(parts)
+
+
+def write_with_minidom(file, title, created, updated, tags, content):
+    root = ET.Element("en-export")
+    root.set("export-date", datetime.now().strftime("%Y%m%dT%H%M%SZ"))
+    root.set("application", "Evernote")
+    root.set("version", "10.44.8")
+    note_elem = ET.SubElement(root, "note")
+    ET.SubElement(note_elem, "title").text = title
+    ET.SubElement(note_elem, "created").text = created
+    ET.SubElement(note_elem, "updated").text = updated
+    ET.SubElement(note_elem, "tags").text = tags
+    ET.SubElement(note_elem, "content").text = content
+    file.write(minidom.parseString(ET.tostring(root)).toprettyxml(indent="  "))
+
+
+def write_streaming(file, title, created, updated, tags, content):
+    export_module.write_enex_header(file, datetime.now().strftime("%Y%m%dT%H%M%SZ"))
+    export_module.write_enex_note(file, title, created, updated, tags, content)
+    export_module.write_enex_footer(file)
+
+
+def measure(writer, path, content, repeat):
+    args = ("Notebook - A <large> & synthetic note", "20230601T120000Z", "20230602T120000Z", "tag1,tag2", content)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        with open(path, "w", encoding="utf-8") as file:
+            writer(file, *args)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    with open(path, "w", encoding="utf-8") as file:
+        writer(file, *args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # Both writers have to round trip the exact same content
+    parsed_content = ET.parse(path).getroot().find("note").find("content").text
+    assert parsed_content == content
+
+    return elapsed, peak
+
+
+output_directory = tempfile.mkdtemp()
+output_path = os.path.join(output_directory, "benchmark.enex")
+
+print(f"{'note size':>12} {'writer':>10} {'ms/note':>10} {'peak MB':>10}")
+for note_size in [100_000, 1_000_000, 10_000_000]:
+    content = synthetic_enml(note_size)
+    repeat = max(1, 10_000_000 // note_size)
+    for name, writer in [('minidom', write_with_minidom), ('streaming', write_streaming)]:
+        elapsed, peak = measure(writer, output_path, content, repeat)
+        print(f"{note_size:>12} {name:>10} {elapsed * 1000:>10.2f} {peak / 1_000_000:>10.2f}")
+
+os.remove(output_path)
+os.rmdir(output_directory)
@@ -0,0 +1,138 @@
+import argparse
+import os
+import random
+import re
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from langchain.document_loaders import EverNoteLoader
+
+from processor_harness import load_processor_module
+
+# Benchmark and golden output check of the lxml ENML converter of SplitEvernoteText against the html2text converter of the
+# langchain EverNoteLoader on a synthetic ENML corpus.
+# Both converters have to produce the same text for a fixed set of fixture notes and for every synthetic note. Links and
+# emphasis are only kept as their text by the lxml converter, checkboxes are only kept by the lxml converter and tables and
+# line breaks lose the markdown markup html2text gives them, so these differences are normalized away before comparing.
+# html2text runs adjacent tables together, so the blank lines between blocks are not compared for the synthetic notes.
+# Run it with the NiFi python api ($NIFI_HOME/python/api) and the processor dependencies on the PYTHONPATH, e.g:
+#   python enml-converter-benchmark.py --notes 500
+
+split_module = load_processor_module('SplitEvernoteText')
+
+
+def words(note_random, count):
+    return ' '.join(''.join(note_random.choices(string.ascii_lowercase, k=note_random.randint(2, 10))) for _ in range(count))
+
+
+def synthetic_list(note_random, depth):
+    tag = note_random.choice(["ul", "ol"])
+    items = []
+    for _ in range(note_random.randint(1, 5)):
+        item = words(note_random, note_random.randint(1, 12))
+        if depth < 2 and note_random.random() < 0.2:
+            item += synthetic_list(note_random, depth + 1)
+        items.append(f"<li>{item}</li>")
+    return f"<{tag}>{''.join(items)}</{tag}>"
+
+
+def synthetic_enml(note_random, size_in_bytes):
+    # Paragraphs with inline markup and entities, headings, nested lists, checkboxes, tables, line breaks and media
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="no"?>',
+             '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">', '<en-note>']
+    length = 0
+    while length < size_in_bytes:
+        kind = note_random.randint(0, 6)
+        if kind == 0:
+            level = note_random.randint(1, 3)
+            part = f"<h{level}>{words(note_random, 4)}</h{level}>"
+        elif kind == 1:
+            part = synthetic_list(note_random, 0)
+        elif kind == 2:
+            part = f'<div><en-todo checked="{note_random.choice(["true", "false"])}"/>{words(note_random, 6)}</div>'
+        elif kind == 3:
+            part = f"<table><tr><td>{words(note_random, 2)}</td><td>{words(note_random, 2)}</td></tr><tr><td>{words(note_random, 2)}</td><td>{words(note_random, 2)}</td></tr></table>"
+        elif kind == 4:
+            part = f"<div>{words(note_random, 10)}<br/>{words(note_random, 10)}</div>"
+        elif kind == 5:
+            part = f'<div><en-media hash="{note_random.getrandbits(64):016x}" type="image/png"/></div>'
+        else:
+            part = (f'<div>{words(note_random, 20)} <b>{words(note_random, 3)}</b> &amp; &lt;{words(note_random, 1)}&gt;&nbsp;'
+                    f'<a href="https://example.com/{words(note_random, 1)}">{words(note_random, 3)}</a> <span style="color:red">{words(note_random, 15)}</span></div>')
+        parts.append(part)
+        length += len(part)
+    parts.append('</en-note>')
+    return ''.join(parts)
+
+
+# One note per kind of ENML markup the synthetic corpus is made of
+FIXTURE_NOTES = [
+    "<h1>first heading</h1><div>text under it</div><h3>third level heading</h3>",
+    "<ul><li>one</li><li>two<ol><li>two a</li><li>two b</li></ol></li><li>three</li></ul>",
+    "<ol><li>one<ul><li>one a</li></ul></li><li>two<ol><li>two a<ol><li>two a i</li></ol></li></ol></li><li>three</li></ol>",
+    '<div><en-todo checked="true"/>done thing</div><div><en-todo checked="false"/>open thing</div>',
+    "<table><tr><td>a b</td><td>c</td></tr><tr><td>d</td><td>e f</td></tr></table>",
+    "<div>line one<br/>line two</div><div>next line</div>",
+    '<div><en-media hash="00ff00ff00ff00ff" type="image/png"/></div><div>after the image</div>',
+    '<div>some <b>bold words</b> &amp; &lt;tag&gt;&nbsp;<a href="https://example.com/page">link text</a> <span style="color:red">red words</span></div>',
+    "<div>" + " ".join(["a paragraph long enough to be wrapped by html2text"] * 4) + "</div><div>next paragraph</div>",
+]
+
+
+def enml_note(body):
+    return ('<?xml version="1.0" encoding="UTF-8" standalone="no"?>'
+            '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">' f'<en-note>{body}</en-note>')
+
+
+def normalize_html2text(text):
+    # html2text wraps the text at 78 columns, a wrapped line does not end in the two spaces of a markdown hard line break.
+    # Links and emphasis become their text, the table header separator and the hard line breaks are dropped
+    text = re.sub(r"(?<=[^ \n])\n *(?!\* |#+ |\d+\. )(?=\S)", " ", text)
+    text = re.sub(r"\[([^\]]*)\]\([^)]*\)", r"\1", text)
+    text = re.sub(r"\*\*|(?<!\w)_|_(?!\w)", "", text)
+    text = re.sub(r"^-+(?:\|-+)+ *\n", "", text, flags=re.MULTILINE)
+    return normalize_table_cells(re.sub(r" +\n", "\n", text))
+
+
+def normalize_lxml(text):
+    # Checkboxes are dropped
+    return normalize_table_cells(re.sub(r"\[[ x]\] ", "", text))
+
+
+def normalize_table_cells(text):
+    return re.sub(r" *\| *", " | ", text)
+
+
+def without_blank_lines(text):
+    return re.sub(r"\n\n+", "\n", text)
+
+
+parser = argparse.ArgumentParser(description="lxml vs html2text ENML converter benchmark and golden output check")
+parser.add_argument("--notes", type=int, default=500, help="The number of synthetic notes")
+parser.add_argument("--note-size", type=int, default=20_000, help="The size of the ENML body of every note in bytes")
+args = parser.parse_args()
+
+for index, body in enumerate(FIXTURE_NOTES):
+    expected = normalize_html2text(EverNoteLoader._parse_content(enml_note(body)))
+    actual = normalize_lxml(split_module.convert_enml_to_text(enml_note(body)))
+    assert expected == actual, f"The text of fixture note {index} differs:\n{expected!r}\n{actual!r}"
+print(f"The golden output check passed for all {len(FIXTURE_NOTES)} fixture notes")
+
+corpus_random = random.Random(42)
+corpus = [synthetic_enml(corpus_random, corpus_random.randint(args.note_size // 4, args.note_size)) for _ in range(args.notes)]
+corpus_megabytes = sum(len(content) for content in corpus) / 1_000_000
+
+outputs = {}
+print(f"{'converter':>10} {'notes':>8} {'MB':>8} {'seconds':>9} {'MB/sec':>8}")
+for name, converter in [('html2text', EverNoteLoader._parse_content), ('lxml', split_module.convert_enml_to_text)]:
+    start = time.perf_counter()
+    outputs[name] = [converter(content) for content in corpus]
+    elapsed = time.perf_counter() - start
+    print(f"{name:>10} {args.notes:>8} {corpus_megabytes:>8.2f} {elapsed:>9.2f} {corpus_megabytes / elapsed:>8.2f}")
+
+for index, (expected, actual) in enumerate(zip(outputs['html2text'], outputs['lxml'])):
+    assert without_blank_lines(normalize_html2text(expected)) == without_blank_lines(normalize_lxml(actual)), f"The text of synthetic note {index} differs"
+print(f"The golden output check passed for all {args.notes} synthetic notes")
@@ -0,0 +1,177 @@
+import bisect
+import calendar
+import hashlib
+import random
+import threading
+import time
+from collections import Counter
+
+from evernote.edam.error.ttypes import EDAMErrorCode, EDAMSystemException
+from evernote.edam.notestore.ttypes import NoteMetadata, NotesMetadataList, SyncChunk, SyncState
+from evernote.edam.type.ttypes import Data, Note, Notebook, NoteSortOrder, Resource, ResourceAttributes, Tag
+
+# An offline stand-in for the Evernote NoteStore with a synthetic account, so ExportNotesFromEvernote can be
+# benchmarked and regression tested without a live Evernote account. Every call can be slowed down by a simulated
+# network latency and the store can reject calls with RATE_LIMIT_REACHED like Evernote does.
+
+
+class FakeNoteStore:
+
+    def __init__(self, number_of_notes, number_of_notebooks=20, number_of_tags=50, content_size=4000,
+                 resource_every=10, resource_size=200_000, latency=0.0, latency_jitter=0.0,
+                 rate_limit_calls=None, rate_limit_window=60, rate_limit_duration=5, seed=42):
+        self.number_of_notes = number_of_notes
+        self.content_size = content_size
+        self.resource_every = resource_every
+        self.resource_size = resource_size
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_limit_calls = rate_limit_calls
+        self.rate_limit_window = rate_limit_window
+        self.rate_limit_duration = rate_limit_duration
+        self.seed = seed
+
+        self.lock = threading.Lock()
+        self.rpc_counts = Counter()
+        self.rate_limit_count = 0
+        self.window_started = time.monotonic()
+        self.window_calls = 0
+
+        # Half of the notebooks are in the 'Home' stack so the stack filter can be exercised
+        self.notebooks = [Notebook(guid=f"notebook-{index:04d}", name=f"Notebook {index}", stack="Home" if index % 2 == 0 else "Work")
+                          for index in range(number_of_notebooks)]
+        self.tags = [Tag(guid=f"tag-{index:04d}", name=f"tag{index}") for index in range(number_of_tags)]
+        self.tag_names_by_guid = {tag.guid: tag.name for tag in self.tags}
+
+        # Only the note summaries are kept in memory. The note content is generated when the note is retrieved
+        self.notes = [self.note_summary(index) for index in range(number_of_notes)]
+        self.notes_by_guid = {note.guid: note for note in self.notes}
+        self.notes_by_notebook = {notebook.guid: [] for notebook in self.notebooks}
+        for note in self.notes:
+            self.notes_by_notebook[note.notebookGuid].append(note)
+        self.index_updated_times()
+
+    def index_updated_times(self):
+        # The updated times of the notes in their sort order, so the 'updated:' search can bisect them. Call it again
+        # after changing the updated time of a note
+        self.updated_times = [note.updated for note in self.notes]
+        self.updated_times_by_notebook = {notebook_guid: [note.updated for note in notes]
+                                          for notebook_guid, notes in self.notes_by_notebook.items()}
+
+    @property
+    def total_rpc_count(self):
+        return sum(self.rpc_counts.values())
+
+    def note_summary(self, index):
+        note_random = random.Random(self.seed + index)
+        return Note(
+            guid=f"{index:08d}-0000-0000-0000-{index:012d}",
+            title=f"Synthetic note {index}",
+            contentHash=hashlib.md5(self.note_content(index).encode("utf-8")).digest(),
+            contentLength=self.content_size,
+            created=1_600_000_000_000 + index * 1000,
+            updated=1_650_000_000_000 + index * 1000,
+            active=True,
+            updateSequenceNum=index + 1,
+            notebookGuid=self.notebooks[index % len(self.notebooks)].guid,
+            tagGuids=[tag.guid for tag in note_random.sample(self.tags, min(3, len(self.tags)))],
+        )
+
+    def note_content(self, index):
+        paragraph = f"<div>Paragraph of synthetic note {index} with some text &amp; markup to export.</div>"
+        paragraphs = paragraph * max(1, self.content_size // len(paragraph))
+        return ('<?xml version="1.0" encoding="UTF-8" standalone="no"?>'
+                '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">'
+                f'<en-note>{paragraphs}</en-note>')
+
+    def note_index(self, note_guid):
+        return int(note_guid.split("-")[0])
+
+    def resource_data(self, resource_guid):
+        return random.Random(resource_guid).randbytes(self.resource_size)
+
+    def call(self, method_name):
+        # Simulate the network round trip and the Evernote rate limit for every call
+        with self.lock:
+            self.rpc_counts[method_name] += 1
+            if self.rate_limit_calls is not None:
+                now = time.monotonic()
+                if now - self.window_started >= self.rate_limit_window:
+                    self.window_started = now
+                    self.window_calls = 0
+                self.window_calls += 1
+                if self.window_calls > self.rate_limit_calls:
+                    self.rate_limit_count += 1
+                    raise EDAMSystemException(errorCode=EDAMErrorCode.RATE_LIMIT_REACHED,
+                                              rateLimitDuration=self.rate_limit_duration)
+        if self.latency > 0 or self.latency_jitter > 0:
+            time.sleep(self.latency + random.uniform(0, self.latency_jitter))
+
+    def listNotebooks(self):
+        self.call("listNotebooks")
+        return list(self.notebooks)
+
+    def listTags(self):
+        self.call("listTags")
+        return list(self.tags)
+
+    def findNotesMetadata(self, note_filter, offset, max_notes, result_spec):
+        self.call("findNotesMetadata")
+        # The notes are kept oldest update first
+        notes = self.notes if note_filter.notebookGuid is None else self.notes_by_notebook[note_filter.notebookGuid]
+        if note_filter.words is not None and note_filter.words.startswith("updated:"):
+            # The only search grammar the processor uses: the notes updated at or after a UTC date/time
+            updated_from = calendar.timegm(time.strptime(note_filter.words[len("updated:"):], "%Y%m%dT%H%M%SZ")) * 1000
+            updated_times = self.updated_times if note_filter.notebookGuid is None else self.updated_times_by_notebook[note_filter.notebookGuid]
+            notes = notes[bisect.bisect_left(updated_times, updated_from):]
+        if note_filter.order == NoteSortOrder.UPDATED and not note_filter.ascending:
+            notes = notes[::-1]
+        page = [NoteMetadata(guid=note.guid, title=note.title, contentLength=note.contentLength, created=note.created,
+                             updated=note.updated, notebookGuid=note.notebookGuid, tagGuids=note.tagGuids)
+                for note in notes[offset:offset + max_notes]]
+        return NotesMetadataList(startIndex=offset, totalNotes=len(notes), notes=page)
+
+    def getNote(self, note_guid, with_content, with_resources_data, with_resources_recognition, with_resources_alternate_data):
+        self.call("getNote")
+        summary = self.notes_by_guid[note_guid]
+        index = self.note_index(note_guid)
+        note = Note(guid=summary.guid, title=summary.title, contentHash=summary.contentHash, contentLength=summary.contentLength,
+                    created=summary.created, updated=summary.updated, active=True, updateSequenceNum=summary.updateSequenceNum,
+                    notebookGuid=summary.notebookGuid, tagGuids=summary.tagGuids)
+        if with_content:
+            note.content = self.note_content(index)
+        if self.resource_every and index % self.resource_every == 0:
+            resource_guid = f"resource-{note_guid}"
+            data = Data(size=self.resource_size, body=self.resource_data(resource_guid) if with_resources_data else None)
+            note.resources = [Resource(guid=resource_guid, noteGuid=note_guid, data=data, mime="application/pdf",
+                                       attributes=ResourceAttributes(fileName=f"attachment-{index}.pdf"))]
+        return note
+
+    def getNoteTagNames(self, note_guid):
+        self.call("getNoteTagNames")
+        return [self.tag_names_by_guid[tag_guid] for tag_guid in self.notes_by_guid[note_guid].tagGuids]
+
+    def getResourceData(self, resource_guid):
+        self.call("getResourceData")
+        return self.resource_data(resource_guid)
+
+    def getSyncState(self):
+        self.call("getSyncState")
+        return SyncState(currentTime=int(time.time() * 1000), fullSyncBefore=0, updateCount=len(self.notes))
+
+    def getFilteredSyncChunk(self, after_usn, max_entries, sync_chunk_filter):
+        self.call("getFilteredSyncChunk")
+        # The USN of a note is its index + 1, so the notes after a USN are a slice of the note list
+        notes = self.notes[after_usn:after_usn + max_entries]
+        return SyncChunk(currentTime=int(time.time() * 1000), updateCount=len(self.notes),
+                         chunkHighUSN=notes[-1].updateSequenceNum if len(notes) > 0 else None, notes=notes)
+
+
+class FakeEvernoteClient:
+    # Hands out the fake note store wherever the processor asks the EvernoteClient for one
+
+    def __init__(self, note_store):
+        self.note_store = note_store
+
+    def get_note_store(self):
+        return self.note_store
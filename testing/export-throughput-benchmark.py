@@ -0,0 +1,109 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from evernote_fake_note_store import FakeEvernoteClient, FakeNoteStore
+from processor_harness import FlowFile, Logger, ProcessContext, load_processor_module
+
+# Export throughput benchmark of ExportNotesFromEvernote against the offline fake note store.
+# Reports notes/sec, the number of Evernote API calls and the bytes written for synthetic accounts, along with the
+# calls a second run with nothing changed costs.
+# Run it with the NiFi python api ($NIFI_HOME/python/api) and the processor dependencies on the PYTHONPATH, e.g:
+#   python export-throughput-benchmark.py --notes 1000 10000 100000 --latency 0.01 --parallelism 8
+
+export_module = load_processor_module('ExportNotesFromEvernote')
+
+
+class BenchmarkExportNotesFromEvernote(export_module.ExportNotesFromEvernote):
+
+    def __init__(self, note_store, verbose, **kwargs):
+        super().__init__(**kwargs)
+        self.fake_note_store = note_store
+        self.logger = Logger(verbose)
+
+    def create_evernote_client(self, evernote_auth_token):
+        return FakeEvernoteClient(self.fake_note_store)
+
+
+def bytes_written(export_directory, results):
+    if any(result.contents is not None for result in results):
+        return sum(len(result.contents) for result in results if result.contents is not None)
+    return sum(os.path.getsize(os.path.join(export_directory, file_name))
+               for file_name in os.listdir(export_directory) if not file_name.startswith('.'))
+
+
+def run_benchmark(number_of_notes, args):
+    note_store = FakeNoteStore(number_of_notes, latency=args.latency, latency_jitter=args.latency_jitter,
+                               rate_limit_calls=args.rate_limit_calls, rate_limit_window=args.rate_limit_window,
+                               rate_limit_duration=args.rate_limit_duration, content_size=args.content_size)
+    export_directory = tempfile.mkdtemp()
+    try:
+        processor = BenchmarkExportNotesFromEvernote(note_store, args.verbose)
+        context = ProcessContext(processor, {
+            "Evernote Authentication Token": "offline",
+            "Export Directory": export_directory,
+            "Note Fetch Parallelism": args.parallelism,
+            "Export Mode": args.export_mode,
+            "Output Destination": args.output_destination,
+            "Resource Export": args.resource_export,
+            "Notes per Export File": args.notes_per_export_file,
+            "Notes per FlowFile": args.notes_per_flowfile,
+            "Max Megabytes per Export File": args.max_megabytes_per_export_file,
+        })
+        processor.onScheduled(context)
+
+        # A FlowFile holds a limited number of notes, so the run is triggered until it is complete
+        start = time.perf_counter()
+        results = [processor.transform(context, FlowFile())]
+        while results[-1].attributes["evernote.export.run.complete"] != "true":
+            results.append(processor.transform(context, FlowFile()))
+        elapsed = time.perf_counter() - start
+        full_run_rpc_count = note_store.total_rpc_count
+        full_run_rpc_counts = dict(note_store.rpc_counts)
+        full_run_bytes = bytes_written(export_directory, results)
+        exported_note_count = sum(int(result.attributes['evernote.export.note.count']) for result in results)
+        throttled_seconds = sum(float(result.attributes['evernote.export.throttled.seconds']) for result in results)
+
+        # A second run right after the first has nothing to export
+        note_store.rpc_counts.clear()
+        processor.transform(context, FlowFile())
+        rerun_rpc_count = note_store.total_rpc_count
+
+        processor.onStopped(context)
+
+        print(f"{number_of_notes:>8} {exported_note_count:>9} "
+              f"{elapsed:>9.2f} {number_of_notes / elapsed:>10.1f} {full_run_rpc_count:>8} "
+              f"{full_run_bytes / 1_000_000:>10.2f} {throttled_seconds:>10.2f} "
+              f"{rerun_rpc_count:>10}")
+        if args.verbose:
+            print("RPC calls by method: " + str(full_run_rpc_counts) + " over " + str(len(results)) + " triggers")
+    finally:
+        shutil.rmtree(export_directory)
+
+
+parser = argparse.ArgumentParser(description="Export throughput benchmark of ExportNotesFromEvernote against a fake note store")
+parser.add_argument("--notes", type=int, nargs="+", default=[1000, 10000, 100000], help="The number of notes of each synthetic account")
+parser.add_argument("--content-size", type=int, default=4000, help="The size of the content of every note in bytes")
+parser.add_argument("--latency", type=float, default=0.005, help="The simulated latency of every Evernote API call in seconds")
+parser.add_argument("--latency-jitter", type=float, default=0.0, help="A random extra latency of up to this many seconds")
+parser.add_argument("--rate-limit-calls", type=int, default=None, help="The number of calls allowed per rate limit window")
+parser.add_argument("--rate-limit-window", type=float, default=60, help="The rate limit window in seconds")
+parser.add_argument("--rate-limit-duration", type=int, default=5, help="The rateLimitDuration returned when the rate limit is reached")
+parser.add_argument("--parallelism", type=int, default=4, help="The Note Fetch Parallelism of the processor")
+parser.add_argument("--export-mode", default="Notebook Scan", choices=["Notebook Scan", "Incremental Sync (USN)"])
+parser.add_argument("--output-destination", default="Export Directory", choices=["Export Directory", "FlowFile Content"])
+parser.add_argument("--notes-per-export-file", type=int, default=1, help="The Notes per Export File, the most notes in a batch file")
+parser.add_argument("--notes-per-flowfile", type=int, default=1000, help="The Notes per FlowFile, the most notes in a FlowFile")
+parser.add_argument("--max-megabytes-per-export-file", type=int, default=0, help="The Max Megabytes per Export File of a batch file or FlowFile")
+parser.add_argument("--resource-export", default="None", choices=["None", "Indexed MIME Types"])
+parser.add_argument("--verbose", action="store_true", help="Print the processor log")
+args = parser.parse_args()
+
+print(f"{'notes':>8} {'exported':>9} {'seconds':>9} {'notes/sec':>10} {'RPCs':>8} {'MB written':>10} {'throttled':>10} {'rerun RPCs':>10}")
+for number_of_notes in args.notes:
+    run_benchmark(number_of_notes, args)
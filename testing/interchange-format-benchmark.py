@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from array import array
+
+import msgpack
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from processor_harness import load_processor_module
+
+# Benchmark of the JSON and MessagePack FlowFile content passed from GetOpenAiVectorEmbedding to PutPineconeVectorEmbedding.
+# Reports the serialize and parse time and the size of the content for a number of synthetic 1536 dimension embeddings.
+# Run it with the NiFi python api ($NIFI_HOME/python/api) and the processor dependencies on the PYTHONPATH, e.g:
+#   python interchange-format-benchmark.py --chunks 1000 10000
+
+pinecone_module = load_processor_module('PutPineconeVectorEmbedding')
+
+
+def synthetic_text_embeddings(number_of_chunks, dimensions):
+    chunk_random = random.Random(number_of_chunks)
+    return [{"text": "Synthetic chunk text " * 40,
+             "embedding": [chunk_random.uniform(-0.1, 0.1) for _ in range(dimensions)],
+             "metadata": {"title": f"Note {index}", "created": 1600000000, "updated": 1650000000,
+                          "tags": "tag1,tag2", "source": f"Notebook__Notebook__Note__Note {index}__Id__{index:04d}.enex"}}
+            for index in range(number_of_chunks)]
+
+
+def write_json(text_embeddings):
+    return json.dumps(text_embeddings).encode('utf-8')
+
+
+def write_msgpack(text_embeddings):
+    # GetOpenAiVectorEmbedding writes the little-endian float32 buffers OpenAI returns
+    return msgpack.packb([{"text": text_embedding["text"], "embedding": array('f', text_embedding["embedding"]).tobytes(),
+                           "metadata": text_embedding["metadata"]} for text_embedding in text_embeddings])
+
+
+def read(contents):
+    # The same parsing PutPineconeVectorEmbedding does before it upserts
+    if pinecone_module.is_json_content(contents):
+        docs = json.loads(contents.decode('utf-8'))
+    else:
+        docs = msgpack.unpackb(contents)
+    return [pinecone_module.unpack_embedding(doc["embedding"]) for doc in docs]
+
+
+parser = argparse.ArgumentParser(description="JSON vs MessagePack FlowFile content benchmark for text embeddings")
+parser.add_argument("--chunks", type=int, nargs="+", default=[1000, 10000], help="The number of text embeddings in the FlowFile")
+parser.add_argument("--dimensions", type=int, default=1536, help="The dimensions of every embedding")
+args = parser.parse_args()
+
+print(f"{'chunks':>8} {'format':>12} {'write ms':>10} {'read ms':>10} {'MB':>10}")
+for number_of_chunks in args.chunks:
+    text_embeddings = synthetic_text_embeddings(number_of_chunks, args.dimensions)
+    for name, writer in [('JSON', write_json), ('MessagePack', write_msgpack)]:
+        start = time.perf_counter()
+        contents = writer(text_embeddings)
+        write_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        embeddings = read(contents)
+        read_elapsed = time.perf_counter() - start
+
+        # float32 keeps about 7 significant digits of every value
+        assert all(abs(a - b) < 1e-6 for a, b in zip(embeddings[-1], text_embeddings[-1]["embedding"]))
+        print(f"{number_of_chunks:>8} {name:>12} {write_elapsed * 1000:>10.1f} {read_elapsed * 1000:>10.1f} {len(contents) / 1_000_000:>10.2f}")
@@ -0,0 +1,194 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from openai_mock_server import MockOpenAIServer, deterministic_embedding
+
+# Load benchmark of GetOpenAiVectorEmbedding, GetPineconeVectorSemanticSearch and GetChatResponseOpenAILLM against the
+# local OpenAI mock server, so no billable API calls are made. Pinecone is replaced by an in memory index of synthetic notes.
+# Reports the throughput and the p50/p95/p99 latency of every processor, along with the time to the first token and the
+# total time of streamed chat completions.
+# Run it with the NiFi python api ($NIFI_HOME/python/api) and the processor dependencies on the PYTHONPATH, e.g:
+#   python openai-load-benchmark.py --latency lognormal:0.15,0.4 --rate-limit-probability 0.02 --flowfiles 20
+
+
+def percentile(values, percent):
+    # Nearest rank percentile
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def print_result(name, operations, unit, elapsed, latencies):
+    print(f"{name:>10} {operations:>7} {unit:>7} {elapsed:>9.2f} {operations / elapsed:>10.1f} "
+          f"{percentile(latencies, 50) * 1000:>9.1f} {percentile(latencies, 95) * 1000:>9.1f} {percentile(latencies, 99) * 1000:>9.1f}")
+
+
+def synthetic_chunks(flowfile_number, number_of_chunks):
+    chunk_random = random.Random(flowfile_number)
+    chunks = []
+    for index in range(number_of_chunks):
+        text = " ".join(chunk_random.choice(["note", "meeting", "budget", "travel", "recipe", "project", "idea", "plan"]) for _ in range(150))
+        chunks.append({"page_content": f"{flowfile_number} {index} {text}", "metadata_title": f"Note {index}",
+                       "metadata_created": 1600000000, "metadata_updated": 1650000000, "metadata_tags": "tag1,tag2",
+                       "metadata_source": f"Notebook__Benchmark__Note__Note {index}__Id__{index:04d}.enex",
+                       "metadata_token_count": 150})
+    return chunks
+
+
+def install_fake_pinecone(index_size, dimensions):
+    # Pinecone is replaced by an in memory index of synthetic notes. It is brute force searched with numpy
+    import numpy
+    import pinecone
+
+    texts = [f"Synthetic note {index} about " + random.Random(index).choice(["budget", "travel", "recipes", "projects"]) for index in range(index_size)]
+    vectors = numpy.array([deterministic_embedding("text-embedding-ada-002", text, dimensions) for text in texts], dtype=numpy.float32)
+
+    class FakePineconeIndex(pinecone.Index):
+
+        def __init__(self, index_name, pool_threads=1):
+            self.index_name = index_name
+
+        def query(self, vector=None, top_k=10, include_metadata=True, namespace=None, filter=None, **kwargs):
+            query_vector = numpy.array(vector, dtype=numpy.float32).reshape(-1)
+            scores = vectors @ query_vector
+            return {"matches": [{"id": str(index), "score": float(scores[index]),
+                                 "metadata": {"text": texts[index], "source": f"Notebook__Benchmark__Note__Note {index}__Id__{index:04d}.enex"}}
+                                for index in numpy.argsort(-scores)[:top_k]]}
+
+    pinecone.init = lambda **kwargs: None
+    pinecone.list_indexes = lambda: ["benchmark"]
+    pinecone.Index = FakePineconeIndex
+
+
+def benchmark_embedding(processor_harness, args):
+    module = processor_harness.load_processor_module('GetOpenAiVectorEmbedding')
+    processor = module.GetOpenAiVectorEmbedding()
+    processor.logger = processor_harness.Logger(args.verbose)
+    context = processor_harness.ProcessContext(processor, {"OpenAI API Key": "mock", "Chunk Size": args.chunk_size,
+                                                           "Max Concurrent Requests": args.concurrency, "Output Format": "MessagePack"})
+    processor.onScheduled(context)
+    flowfiles = [processor_harness.FlowFile(json.dumps(synthetic_chunks(number, args.chunks_per_flowfile)).encode("utf-8"))
+                 for number in range(args.flowfiles)]
+
+    latencies = []
+    start = time.perf_counter()
+    for flowfile in flowfiles:
+        transform_start = time.perf_counter()
+        result = processor.transform(context, flowfile)
+        latencies.append(time.perf_counter() - transform_start)
+        assert result.relationship == "success", result.attributes
+    elapsed = time.perf_counter() - start
+    processor.onStopped(context)
+    print_result("embedding", args.flowfiles * args.chunks_per_flowfile, "chunks", elapsed, latencies)
+
+
+def benchmark_search(processor_harness, args):
+    module = processor_harness.load_processor_module('GetPineconeVectorSemanticSearch')
+    processor = module.GetPineconeVectorSemanticSearch()
+    processor.logger = processor_harness.Logger(args.verbose)
+    context = processor_harness.ProcessContext(processor, {"OpenAI API Key": "mock", "Pinecone API Key": "mock", "Pinecone Env Name": "mock",
+                                                           "Index Name": "benchmark", "Namepace": "benchmark"})
+    processor.onScheduled(context)
+
+    latencies = []
+    start = time.perf_counter()
+    for number in range(args.queries):
+        transform_start = time.perf_counter()
+        result = processor.transform(context, processor_harness.FlowFile(f"What did I plan for the budget {number}?".encode("utf-8")))
+        latencies.append(time.perf_counter() - transform_start)
+        assert len(json.loads(result.contents)) > 0
+    elapsed = time.perf_counter() - start
+    print_result("search", args.queries, "queries", elapsed, latencies)
+
+
+def benchmark_chat(processor_harness, args):
+    module = processor_harness.load_processor_module('GetChatResponseOpenAILLM')
+    processor = module.GetChatResponseOpenAILLM()
+    processor.logger = processor_harness.Logger(args.verbose)
+    context = processor_harness.ProcessContext(processor, {"OpenAI API Key": "mock", "Pinecone API Key": "mock", "Pinecone Env Name": "mock",
+                                                           "Index Name": "benchmark", "Namepace": "benchmark", "User Name": "benchmark",
+                                                           "question": "What did I plan for the budget?",
+                                                           "chat_history": '("What is in my notes?", "Budgets and travel plans.")'})
+    processor.onScheduled(context)
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(args.queries):
+        transform_start = time.perf_counter()
+        # The question generator chain of the processor is verbose and prints every prompt
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+            result = processor.transform(context, processor_harness.FlowFile())
+        latencies.append(time.perf_counter() - transform_start)
+        assert len(result.contents) > 0
+    elapsed = time.perf_counter() - start
+    print_result("chat", args.queries, "answers", elapsed, latencies)
+
+
+def benchmark_streaming(args):
+    # The processors do not stream, so the streamed chat completions are measured with the openai client directly
+    import openai
+
+    first_token_latencies = []
+    latencies = []
+    start = time.perf_counter()
+    for number in range(args.queries):
+        request_start = time.perf_counter()
+        first_token = None
+        for chunk in openai.ChatCompletion.create(model="gpt-3.5-turbo", api_key="mock", stream=True,
+                                                  messages=[{"role": "user", "content": f"What did I plan for the budget {number}?"}]):
+            if first_token is None and chunk["choices"][0]["delta"].get("content"):
+                first_token = time.perf_counter() - request_start
+        first_token_latencies.append(first_token)
+        latencies.append(time.perf_counter() - request_start)
+    elapsed = time.perf_counter() - start
+    print_result("stream", args.queries, "answers", elapsed, latencies)
+    print_result("1st token", args.queries, "answers", elapsed, first_token_latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark of the OpenAI processors against a local OpenAI mock server")
+    parser.add_argument("--processors", nargs="+", default=["embedding", "search", "chat", "stream"], choices=["embedding", "search", "chat", "stream"])
+    parser.add_argument("--flowfiles", type=int, default=10, help="The number of FlowFiles GetOpenAiVectorEmbedding embeds")
+    parser.add_argument("--chunks-per-flowfile", type=int, default=500, help="The number of text chunks of every FlowFile")
+    parser.add_argument("--chunk-size", type=int, default=100, help="The Chunk Size, the texts per embedding request")
+    parser.add_argument("--concurrency", type=int, default=4, help="The Max Concurrent Requests of GetOpenAiVectorEmbedding")
+    parser.add_argument("--queries", type=int, default=50, help="The number of search queries and chat questions")
+    parser.add_argument("--index-size", type=int, default=1000, help="The number of notes in the in memory Pinecone index")
+    parser.add_argument("--latency", default="lognormal:0.1,0.3", help="constant:s, uniform:low,high, exponential:mean or lognormal:median,sigma")
+    parser.add_argument("--latency-per-input", type=float, default=0.0005, help="Extra seconds of latency for every text of an embedding request")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0, help="The share of requests rejected with a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="The Retry-After header of the 429 responses in seconds")
+    parser.add_argument("--stream-token-latency", type=float, default=0.01, help="The seconds between the streamed chat completion chunks")
+    parser.add_argument("--dimensions", type=int, default=1536, help="The dimensions of the mock embeddings")
+    parser.add_argument("--verbose", action="store_true", help="Print the processor log")
+    args = parser.parse_args()
+
+    mock_server = MockOpenAIServer(latency=args.latency, latency_per_input=args.latency_per_input,
+                                   rate_limit_probability=args.rate_limit_probability, retry_after=args.retry_after,
+                                   stream_token_latency=args.stream_token_latency, dimensions=args.dimensions).start()
+    # The openai client reads the api base when it is imported, so it is set before the processors are loaded
+    os.environ["OPENAI_API_BASE"] = mock_server.url
+    import processor_harness
+    install_fake_pinecone(args.index_size, args.dimensions)
+
+    print(f"{'processor':>10} {'count':>7} {'unit':>7} {'seconds':>9} {'count/sec':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    benchmarks = {"embedding": lambda: benchmark_embedding(processor_harness, args),
+                  "search": lambda: benchmark_search(processor_harness, args),
+                  "chat": lambda: benchmark_chat(processor_harness, args),
+                  "stream": lambda: benchmark_streaming(args)}
+    for name in args.processors:
+        benchmarks[name]()
+    print("Mock server requests: " + str(dict(mock_server.request_counts)) + ", rejected with 429: " + str(mock_server.rate_limit_count))
+    mock_server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from array import array
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the OpenAI embeddings and chat completions endpoints, so GetOpenAiVectorEmbedding,
+# GetPineconeVectorSemanticSearch and GetChatResponseOpenAILLM can be load tested without billable API calls.
+# The vectors are deterministic for a model and text, every request is slowed down by a latency drawn from a configurable
+# distribution, requests can be rejected with a 429 like OpenAI does and chat completions can be streamed.
+# Point the openai client at it with OPENAI_API_BASE=http://127.0.0.1:<port>/v1, or run it on its own:
+#   python openai_mock_server.py --port 8080 --latency lognormal:0.2,0.5 --rate-limit-probability 0.05
+
+MODEL_DIMENSIONS = {'text-embedding-ada-002': 1536, 'text-davinci-001': 12288, 'text-curie-001': 4096,
+                    'text-babbage-001': 2048, 'text-ada-001': 1024}
+
+
+class LatencyDistribution:
+    # Parses 'constant:seconds', 'uniform:low,high', 'exponential:mean' or 'lognormal:median,sigma'
+
+    def __init__(self, spec):
+        self.spec = spec
+        kind, _, parameters = spec.partition(':')
+        self.kind = kind
+        self.parameters = [float(parameter) for parameter in parameters.split(',') if parameter != '']
+        if kind not in ['constant', 'uniform', 'exponential', 'lognormal']:
+            raise ValueError("Unknown latency distribution " + spec)
+
+    def sample(self, latency_random):
+        if self.kind == 'constant':
+            return self.parameters[0] if self.parameters else 0.0
+        if self.kind == 'uniform':
+            return latency_random.uniform(self.parameters[0], self.parameters[1])
+        if self.kind == 'exponential':
+            return latency_random.expovariate(1 / self.parameters[0])
+        return latency_random.lognormvariate(math.log(self.parameters[0]), self.parameters[1])
+
+
+def deterministic_embedding(model_name, text, dimensions):
+    # A unit vector seeded by the model and the text, so the same text always gets the same vector
+    seed = int.from_bytes(hashlib.sha256((model_name + "\x00" + text).encode("utf-8")).digest()[:8], "little")
+    vector_random = random.Random(seed)
+    vector = [vector_random.gauss(0, 1) for _ in range(dimensions)]
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector]
+
+
+def embedding_inputs(request_input):
+    # The input is a text, a list of texts, a list of tokens or a list of token lists like langchain sends. Returns the
+    # inputs as texts along with their approximate token counts
+    if isinstance(request_input, str):
+        request_input = [request_input]
+    elif len(request_input) > 0 and isinstance(request_input[0], int):
+        request_input = [request_input]
+    inputs = []
+    for item in request_input:
+        if isinstance(item, str):
+            inputs.append((item, max(1, len(item) // 4)))
+        else:
+            inputs.append((json.dumps(item), len(item)))
+    return inputs
+
+
+class MockOpenAIServer:
+
+    def __init__(self, host='127.0.0.1', port=0, latency='constant:0', latency_per_input=0.0, rate_limit_probability=0.0,
+                 retry_after=1, stream_token_latency=0.0, dimensions=None, seed=42):
+        self.latency = LatencyDistribution(latency)
+        self.latency_per_input = latency_per_input
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after = retry_after
+        self.stream_token_latency = stream_token_latency
+        self.dimensions = dimensions
+
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.request_counts = Counter()
+        self.rate_limit_count = 0
+        self.http_server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.http_server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.http_server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    def next_delay(self, number_of_inputs):
+        # Returns the latency of the request, or None when it is to be rejected with a 429
+        with self.lock:
+            if self.rate_limit_probability > 0 and self.random.random() < self.rate_limit_probability:
+                self.rate_limit_count += 1
+                return None
+            return self.latency.sample(self.random) + self.latency_per_input * number_of_inputs
+
+    def create_embeddings(self, request):
+        model_name = request.get("model", "text-embedding-ada-002")
+        dimensions = self.dimensions or MODEL_DIMENSIONS.get(model_name, 1536)
+        data = []
+        total_tokens = 0
+        for index, (text, token_count) in enumerate(embedding_inputs(request["input"])):
+            vector = deterministic_embedding(model_name, text, dimensions)
+            if request.get("encoding_format") == "base64":
+                vector = base64.b64encode(array('f', vector).tobytes()).decode("ascii")
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+            total_tokens += token_count
+        return {"object": "list", "data": data, "model": model_name, "usage": {"prompt_tokens": total_tokens, "total_tokens": total_tokens}}
+
+    def chat_answer(self, request):
+        question = request["messages"][-1]["content"] if request.get("messages") else ""
+        words = question.split()[-40:]
+        return "Mock answer about " + " ".join(words) + "\nSOURCES: Notebook__Mock__Note__Mock Note__Id__0000.enex"
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, body, headers=None):
+                contents = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(contents)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(contents)
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/models"):
+                    self.send_json(200, {"object": "list", "data": [{"id": model_name, "object": "model"}
+                                                                    for model_name in list(MODEL_DIMENSIONS) + ["gpt-3.5-turbo"]]})
+                else:
+                    self.send_json(404, {"error": {"message": "Unknown path " + self.path, "type": "invalid_request_error"}})
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                endpoint = self.path.split("?")[0].rstrip("/").rsplit("/v1", 1)[-1]
+                if endpoint not in ["/embeddings", "/chat/completions"]:
+                    self.send_json(404, {"error": {"message": "Unknown path " + self.path, "type": "invalid_request_error"}})
+                    return
+                with server.lock:
+                    server.request_counts[endpoint] += 1
+
+                number_of_inputs = len(embedding_inputs(request.get("input", []))) if endpoint == "/embeddings" else 1
+                delay = server.next_delay(number_of_inputs)
+                if delay is None:
+                    self.send_json(429, {"error": {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}},
+                                   {"Retry-After": str(server.retry_after)})
+                    return
+                time.sleep(delay)
+
+                if endpoint == "/embeddings":
+                    self.send_json(200, server.create_embeddings(request))
+                elif request.get("stream"):
+                    self.stream_chat_completion(request)
+                else:
+                    answer = server.chat_answer(request)
+                    self.send_json(200, {"id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()),
+                                         "model": request.get("model"),
+                                         "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                                         "usage": {"prompt_tokens": 0, "completion_tokens": len(answer.split()), "total_tokens": len(answer.split())}})
+
+            def stream_chat_completion(self, request):
+                # Server sent events of a word each, the way OpenAI streams the deltas of a chat completion
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                words = server.chat_answer(request).split(" ")
+                deltas = [{"role": "assistant", "content": ""}] + [{"content": (" " if index > 0 else "") + word} for index, word in enumerate(words)] + [{}]
+                for index, delta in enumerate(deltas):
+                    chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model"),
+                             "choices": [{"index": 0, "delta": delta, "finish_reason": "stop" if index == len(deltas) - 1 else None}]}
+                    self.wfile.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+                    self.wfile.flush()
+                    if server.stream_token_latency > 0:
+                        time.sleep(server.stream_token_latency)
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI compatible embeddings and chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", default="constant:0", help="constant:s, uniform:low,high, exponential:mean or lognormal:median,sigma")
+    parser.add_argument("--latency-per-input", type=float, default=0.0, help="Extra seconds of latency for every text of an embedding request")
+    parser.add_argument("--rate-limit-probability", type=float, default=0.0, help="The share of requests rejected with a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="The Retry-After header of the 429 responses in seconds")
+    parser.add_argument("--stream-token-latency", type=float, default=0.0, help="The seconds between the streamed chat completion chunks")
+    parser.add_argument("--dimensions", type=int, default=None, help="The dimensions of the embeddings instead of the ones of the model")
+    args = parser.parse_args()
+
+    mock_server = MockOpenAIServer(args.host, args.port, args.latency, args.latency_per_input, args.rate_limit_probability,
+                                   args.retry_after, args.stream_token_latency, args.dimensions)
+    print("Serving the OpenAI mock on " + mock_server.url)
+    try:
+        mock_server.http_server.serve_forever()
+    except KeyboardInterrupt:
+        mock_server.stop()
@@ -0,0 +1,81 @@
+import importlib.util
+import os
+import sys
+
+# Helpers to run the NiFi python processors outside of NiFi for benchmarks and regression tests.
+# The NiFi python api ($NIFI_HOME/python/api) and the processor dependencies have to be on the PYTHONPATH.
+
+PROCESSOR_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nifi-processor')
+
+
+def load_processor_module(processor_name):
+    # The module is registered under its name and the processor directory is put on the path like NiFi does, so worker
+    # processes spawned by a processor can import its functions
+    if PROCESSOR_DIRECTORY not in sys.path:
+        sys.path.append(PROCESSOR_DIRECTORY)
+    spec = importlib.util.spec_from_file_location(processor_name, os.path.join(PROCESSOR_DIRECTORY, processor_name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[processor_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class PropertyValue:
+
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+    def asInteger(self):
+        return None if self.value is None or self.value == '' else int(self.value)
+
+    def evaluateAttributeExpressions(self, flowFile=None):
+        return self
+
+
+class ProcessContext:
+    # Properties that are not set fall back to the default value of their descriptor like they do in NiFi
+
+    def __init__(self, processor, properties):
+        self.values = {descriptor.name: descriptor.default_value for descriptor in processor.getPropertyDescriptors()}
+        self.values.update(properties)
+
+    def getProperty(self, descriptor):
+        name = descriptor if isinstance(descriptor, str) else descriptor.name
+        value = self.values.get(name)
+        return PropertyValue(None if value is None else str(value))
+
+
+class FlowFile:
+
+    def __init__(self, contents=b'', attributes=None):
+        self.contents = contents
+        self.attributes = attributes or {}
+
+    def getContentsAsBytes(self):
+        return self.contents
+
+    def getAttribute(self, name):
+        return self.attributes.get(name)
+
+
+class Logger:
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+
+    def info(self, message):
+        if self.verbose:
+            print(message)
+
+    def debug(self, message):
+        if self.verbose:
+            print(message)
+
+    def warn(self, message):
+        print(message)
+
+    def error(self, message):
+        print(message)
@@ -0,0 +1,86 @@
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from processor_harness import FlowFile, Logger, ProcessContext, load_processor_module
+
+# Splitting throughput of SplitEvernoteText over the Split Parallelism for a synthetic multi-note enex document, along with
+# a check that every parallelism emits the same chunks in the same order.
+# Run it with the NiFi python api ($NIFI_HOME/python/api) and the processor dependencies on the PYTHONPATH, e.g:
+#   python split-parallelism-benchmark.py --notes 2000 --parallelism 1 2 4 8
+
+export_module = load_processor_module('ExportNotesFromEvernote')
+split_module = load_processor_module('SplitEvernoteText')
+
+
+def synthetic_enml(note_random, size_in_bytes):
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="no"?>',
+             '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">', '<en-note>']
+    length = 0
+    while length < size_in_bytes:
+        words = ' '.join(''.join(note_random.choices(string.ascii_lowercase, k=note_random.randint(2, 10))) for _ in range(60))
+        part = f'<div>{words} &amp; <b>bold</b></div><ul><li>{words[:80]}</li><li><en-todo checked="true"/>{words[80:160]}</li></ul>'
+        parts.append(part)
+        length += len(part)
+    parts.append('</en-note>')
+    return ''.join(parts)
+
+
+def write_synthetic_enex(path, number_of_notes, note_size):
+    note_random = random.Random(number_of_notes)
+    with open(path, "w", encoding="utf-8") as file:
+        export_module.write_enex_header(file, "20230601T120000Z")
+        for index in range(number_of_notes):
+            export_module.write_enex_note(file, f"Notebook - Note {index}", "20230601T120000Z", "20230602T120000Z", "tag1,tag2",
+                                          synthetic_enml(note_random, note_size), None,
+                                          f"Notebook__Notebook__Note__Note {index}__Id__{index:04d}.enex")
+        export_module.write_enex_footer(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SplitEvernoteText throughput over the Split Parallelism")
+    parser.add_argument("--notes", type=int, default=2000, help="The number of notes in the enex document")
+    parser.add_argument("--note-size", type=int, default=10_000, help="The size of the ENML body of every note in bytes")
+    parser.add_argument("--parallelism", type=int, nargs="+", default=[1, 2, 4], help="The Split Parallelism values to measure")
+    parser.add_argument("--enml-converter", default="lxml", choices=["html2text", "lxml"])
+    args = parser.parse_args()
+
+    enex_path = os.path.join(tempfile.mkdtemp(), "Evernote_Export__Benchmark__Batch__00001.enex")
+    write_synthetic_enex(enex_path, args.notes, args.note_size)
+
+    expected_contents = None
+    print(f"{'parallelism':>12} {'seconds':>9} {'notes/sec':>10} {'speedup':>8}")
+    for split_parallelism in args.parallelism:
+        processor = split_module.SplitEvernoteText()
+        processor.logger = Logger()
+        context = ProcessContext(processor, {"PDF Document File": enex_path, "ENML Converter": args.enml_converter,
+                                             "Split Parallelism": split_parallelism})
+        processor.onScheduled(context)
+        # Warm the worker processes up so their start up is not measured
+        if processor.process_pool is not None:
+            list(processor.process_pool.map(split_module.get_text_splitter, [1000] * split_parallelism, [100] * split_parallelism, [None] * split_parallelism))
+
+        start = time.perf_counter()
+        result = processor.transform(context, FlowFile())
+        elapsed = time.perf_counter() - start
+        processor.onStopped(context)
+
+        if expected_contents is None:
+            expected_contents = result.contents
+            baseline = elapsed
+        assert result.contents == expected_contents, f"The chunks of Split Parallelism {split_parallelism} differ"
+        print(f"{split_parallelism:>12} {elapsed:>9.2f} {args.notes / elapsed:>10.1f} {baseline / elapsed:>8.2f}")
+
+    os.remove(enex_path)
+    os.rmdir(os.path.dirname(enex_path))
+
+
+# The worker processes are spawned and import this script again
+if __name__ == "__main__":
+    main()